@@ -0,0 +1,186 @@
+import argparse
+import gc
+import json
+import os
+import time
+
+import datasets
+import numpy as np
+import torch
+from tabulate import tabulate
+
+from surya.input.processing import slice_bboxes_from_image
+from surya.model.recognition.model import load_model
+from surya.model.recognition.processor import load_processor
+from surya.recognition import batch_recognition, get_batch_size, start_decode_batch
+from surya.settings import settings
+
+ATTENTION_IMPLEMENTATIONS = ["eager", "sdpa"]
+# Max absolute logit difference allowed vs eager, by model dtype
+DEFAULT_TOLERANCES = {torch.float32: 1e-3, torch.float16: 5e-2, torch.bfloat16: 1e-1}
+
+
+def load_lines(max_lines, langs=None):
+    dataset = datasets.load_dataset(settings.RECOGNITION_BENCH_DATASET_NAME, split="train")
+    if langs:
+        dataset = dataset.filter(lambda x: x["language"] in langs)
+
+    lines = []
+    line_langs = []
+    for row in dataset:
+        slices = slice_bboxes_from_image(row["image"].convert("RGB"), row["bboxes"])
+        lang = row["language"] if isinstance(row["language"], list) else [row["language"]]
+        lines.extend(slices)
+        line_langs.extend([lang] * len(slices))
+        if len(lines) >= max_lines:
+            break
+    return lines[:max_lines], line_langs[:max_lines]
+
+
+def mix_langs(line_langs):
+    # Give every other line an extra language, so decoder prompts are left padded and masked
+    mixed = []
+    for i, lang in enumerate(line_langs):
+        if i % 2 == 1:
+            lang = lang + ["en" if "en" not in lang else "fr"]
+        mixed.append(lang)
+    return mixed
+
+
+def first_batch_logits(lines, langs, model, processor, batch_size):
+    # Logits from one teacher forced pass, to compare the backends directly
+    model_inputs = processor(text=[""] * len(lines[:batch_size]), images=lines[:batch_size], lang=langs[:batch_size])
+    batch_langs = torch.from_numpy(np.array(model_inputs["langs"], dtype=np.int64)).to(model.device)
+    pixel_values = torch.from_numpy(model_inputs["pixel_values"]).to(model.device, dtype=model.dtype)
+    decoder_input = torch.from_numpy(np.array([[model.config.decoder_start_token_id] + lang for lang in model_inputs["langs"]], dtype=np.int64)).to(model.device)
+    with torch.inference_mode():
+        return model(pixel_values=pixel_values, decoder_input_ids=decoder_input, decoder_langs=batch_langs).logits.float().cpu()
+
+
+def cached_decode_logits(lines, langs, model, processor, steps, static_cache, tokens=None):
+    # Logits from decoding with the kv cache, after a left padded prompt.  Pass tokens from another backend to feed
+    # both the same inputs, so one flipped argmax doesn't make every later step incomparable.
+    line_langs = processor.tokenizer([""] * len(langs), langs)["langs"]
+    if static_cache:
+        model.decoder.set_static_cache(len(lines), 1 + max(len(lang) for lang in line_langs) + steps)
+    else:
+        model.decoder.clear_static_cache()
+
+    step_logits = []
+    step_tokens = []
+    with torch.inference_mode():
+        batch = start_decode_batch(list(range(len(lines))), lines, line_langs, model, processor)
+        attention_mask = batch.attention_mask
+        past_key_values = batch.past_key_values
+        position_ids = batch.position_ids
+        next_tokens = batch.next_tokens
+        for step in range(steps):
+            input_tokens = tokens[step] if tokens is not None else next_tokens
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(lines), 1))], dim=1)
+            outputs = model.decoder(
+                input_ids=input_tokens.unsqueeze(1),
+                attention_mask=attention_mask,
+                langs=batch.langs,
+                encoder_hidden_states=batch.encoder_hidden_states,
+                past_key_values=past_key_values,
+                position_ids=position_ids.unsqueeze(1),
+                use_cache=True,
+                return_dict=True
+            )
+            past_key_values = outputs.past_key_values
+            position_ids = position_ids + 1
+            logits = outputs.logits[:, -1].float()
+            step_logits.append(logits.cpu())
+            step_tokens.append(input_tokens)
+            next_tokens = logits.argmax(dim=-1)
+    model.decoder.clear_static_cache()
+    return torch.stack(step_logits, dim=1), step_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recognition decoder attention backends for parity and speed.  Exits with an error if a backend is outside the tolerance.")
+    parser.add_argument("--results_dir", type=str, help="Path to JSON file with benchmark results.", default=os.path.join(settings.RESULT_DIR, "benchmark"))
+    parser.add_argument("--max", type=int, help="Maximum number of text lines to recognize.", default=256)
+    parser.add_argument("--langs", type=str, help="Specify certain languages to benchmark.", default=None)
+    parser.add_argument("--parity_lines", type=int, help="Number of lines in the parity batches.", default=16)
+    parser.add_argument("--parity_steps", type=int, help="Number of cached decoding steps to compare.", default=16)
+    parser.add_argument("--tolerance", type=float, help="Max absolute logit difference vs eager. Defaults to a value for the model dtype.", default=None)
+    args = parser.parse_args()
+
+    # Each backend has to decode every line
+    settings.RECOGNITION_LINE_CACHE_SIZE = 0
+    tolerance = args.tolerance if args.tolerance is not None else DEFAULT_TOLERANCES[settings.MODEL_DTYPE]
+
+    langs = args.langs.split(",") if args.langs else None
+    lines, line_langs = load_lines(args.max, langs)
+    parity_lines = lines[:args.parity_lines]
+    parity_langs = mix_langs(line_langs[:args.parity_lines])
+    # Group lines by language, so batches have the same number of language tokens
+    order = sorted(range(len(lines)), key=lambda i: len(line_langs[i]))
+    lines = [lines[i] for i in order]
+    line_langs = [line_langs[i] for i in order]
+    processor = load_processor()
+    print(f"Loaded {len(lines)} lines.")
+
+    base_impl = ATTENTION_IMPLEMENTATIONS[0]
+    parity_cases = {"prefill": None, "masked_cache": False, "masked_static_cache": True}
+    out_data = {}
+    logits = {}
+    base_tokens = {}
+    texts = {}
+    for impl in ATTENTION_IMPLEMENTATIONS:
+        settings.RECOGNITION_ATTENTION_IMPLEMENTATION = impl
+        model = load_model()
+        logits[impl] = {"prefill": first_batch_logits(lines, line_langs, model, processor, get_batch_size())}
+        for case, static_cache in parity_cases.items():
+            if static_cache is None:
+                continue
+            # Every backend decodes the tokens eager picked
+            logits[impl][case], tokens = cached_decode_logits(parity_lines, parity_langs, model, processor, args.parity_steps, static_cache, base_tokens.get(case))
+            if impl == base_impl:
+                base_tokens[case] = tokens
+
+        start = time.time()
+        texts[impl], stats = batch_recognition(lines, line_langs, model, processor, return_stats=True)
+        total_time = time.time() - start
+
+        out_data[impl] = {
+            "time": total_time,
+            "decode_steps": stats["decode_steps"],
+            "tokens_per_sec": stats["decode_steps"] / total_time,
+        }
+
+        del model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    failed = []
+    for impl in ATTENTION_IMPLEMENTATIONS:
+        logit_diffs = {case: float((logits[impl][case] - logits[base_impl][case]).abs().max()) for case in parity_cases}
+        out_data[impl]["logit_diffs"] = logit_diffs
+        out_data[impl]["max_logit_diff"] = max(logit_diffs.values())
+        out_data[impl]["matching_lines"] = sum(a == b for a, b in zip(texts[impl], texts[base_impl])) / max(len(lines), 1)
+        out_data[impl]["parity"] = out_data[impl]["max_logit_diff"] <= tolerance
+        if not out_data[impl]["parity"]:
+            failed.append(impl)
+
+    result_path = os.path.join(args.results_dir, "attention")
+    os.makedirs(result_path, exist_ok=True)
+    with open(os.path.join(result_path, "results.json"), "w+") as f:
+        json.dump(out_data, f, indent=4)
+
+    table_headers = ["Backend", "Time (s)", "Tokens/sec"] + [f"{case} logit diff" for case in parity_cases] + [f"Lines matching {base_impl}", f"Within {tolerance}"]
+    table_data = [
+        [impl, out_data[impl]["time"], out_data[impl]["tokens_per_sec"]] + [out_data[impl]["logit_diffs"][case] for case in parity_cases] + [out_data[impl]["matching_lines"], out_data[impl]["parity"]]
+        for impl in ATTENTION_IMPLEMENTATIONS
+    ]
+    print(tabulate(table_data, headers=table_headers, tablefmt="github"))
+    print(f"Wrote results to {result_path}")
+
+    if len(failed) > 0:
+        raise SystemExit(f"Logits differ from {base_impl} by more than {tolerance} for {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
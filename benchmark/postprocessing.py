@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import cv2
+from tabulate import tabulate
+
+from surya.detection import get_page_splits, run_detection_model, stitch_page_parts, get_batch_size
+from surya.input.processing import open_pdf, get_page_images
+from surya.model.detection.segformer import load_model, load_processor
+from surya.postprocessing.heatmap import detect_boxes, get_and_clean_boxes
+from surya.settings import settings
+
+
+def synthetic_dense_heatmaps(count, height=1280, width=1024, lines=2000):
+    # Mimics a dense newspaper page - thousands of short, thin text lines
+    rng = np.random.default_rng(0)
+    heatmaps = []
+    for _ in range(count):
+        heatmap = rng.random((height, width), dtype=np.float32) * 0.2
+        for _ in range(lines):
+            x = int(rng.integers(0, width - 20))
+            y = int(rng.integers(0, height - 6))
+            line_width = int(rng.integers(8, 160))
+            line_height = int(rng.integers(3, 8))
+            heatmap[y:y + line_height, x:x + line_width] = rng.uniform(0.4, 1.0)
+        heatmaps.append(heatmap)
+    return heatmaps
+
+
+def pdf_heatmaps(pdf_path, max_pages):
+    model = load_model()
+    processor = load_processor()
+
+    doc = open_pdf(pdf_path)
+    page_indices = list(range(min(len(doc), max_pages)))
+    images = get_page_images(doc, page_indices)
+    doc.close()
+
+    heatmaps = []
+    batch_size = get_batch_size()
+    for image in images:
+        _, image_parts, split_heights = get_page_splits(image, processor)
+        pred_parts = []
+        for i in range(0, len(image_parts), batch_size):
+            pred_parts.extend(run_detection_model(image_parts[i:i + batch_size], model, processor))
+        heatmap, _ = stitch_page_parts(pred_parts, split_heights, processor)
+        heatmaps.append(heatmap)
+    return heatmaps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark heatmap postprocessing time per page.")
+    parser.add_argument("--pdf_path", type=str, help="PDF to run the detection model on. Uses synthetic dense heatmaps if not set.", default=None)
+    parser.add_argument("--results_dir", type=str, help="Path to JSON file with benchmark results.", default=os.path.join(settings.RESULT_DIR, "benchmark"))
+    parser.add_argument("--max", type=int, help="Maximum number of pages to benchmark.", default=10)
+    parser.add_argument("--lines", type=int, help="Text lines per synthetic page.", default=2000)
+    args = parser.parse_args()
+
+    if args.pdf_path is not None:
+        heatmaps = pdf_heatmaps(args.pdf_path, args.max)
+    else:
+        heatmaps = synthetic_dense_heatmaps(args.max, lines=args.lines)
+
+    components = []
+    boxes = []
+    detect_times = []
+    total_times = []
+    for heatmap in heatmaps:
+        _, text_score = cv2.threshold(heatmap, settings.DETECTOR_BLANK_THRESHOLD, 1, cv2.THRESH_BINARY)
+        components.append(cv2.connectedComponents(text_score.astype(np.uint8), connectivity=4)[0] - 1)
+
+        start = time.time()
+        detect_boxes(heatmap, settings.DETECTOR_TEXT_THRESHOLD, settings.DETECTOR_BLANK_THRESHOLD)
+        detect_times.append(time.time() - start)
+
+        heatmap_size = list(reversed(heatmap.shape))
+        start = time.time()
+        page_boxes = get_and_clean_boxes(heatmap, heatmap_size, heatmap_size)
+        total_times.append(time.time() - start)
+        boxes.append(len(page_boxes))
+
+    out_data = {
+        "pages": len(heatmaps),
+        "components_per_page": float(np.mean(components)),
+        "boxes_per_page": float(np.mean(boxes)),
+        "detect_boxes_time_per_page": float(np.mean(detect_times)),
+        "postprocess_time_per_page": float(np.mean(total_times)),
+    }
+
+    result_path = os.path.join(args.results_dir, "postprocessing")
+    os.makedirs(result_path, exist_ok=True)
+    with open(os.path.join(result_path, "results.json"), "w+") as f:
+        json.dump(out_data, f, indent=4)
+
+    table_headers = ["Pages", "Components per page", "Boxes per page", "detect_boxes per page (s)", "Postprocess per page (s)"]
+    table_data = [[out_data["pages"], out_data["components_per_page"], out_data["boxes_per_page"], out_data["detect_boxes_time_per_page"], out_data["postprocess_time_per_page"]]]
+    print(tabulate(table_data, headers=table_headers, tablefmt="github"))
+    print(f"Wrote results to {result_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,9 @@ def main():
     parser.add_argument("--tess_cpus", type=int, help="Number of CPUs to use for tesseract.", default=28)
     args = parser.parse_args()
 
+    # Repeated lines would come from the line cache, and skew the timing
+    settings.RECOGNITION_LINE_CACHE_SIZE = 0
+
     rec_model = load_recognition_model()
     rec_processor = load_recognition_processor()
 
@@ -0,0 +1,96 @@
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+from tabulate import tabulate
+
+from surya.input.load import lazy_load_from_file, lazy_load_from_folder
+from surya.settings import settings
+
+
+def encode_page(image) -> str:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running OCR server, and report latency and throughput.")
+    parser.add_argument("input_path", type=str, help="Path to PDF or image file or folder with pages to send.")
+    parser.add_argument("--url", type=str, help="Server URL.", default=f"http://{settings.SERVER_HOST}:{settings.SERVER_PORT}")
+    parser.add_argument("--results_dir", type=str, help="Path to JSON file with benchmark results.", default=os.path.join(settings.RESULT_DIR, "benchmark"))
+    parser.add_argument("--max", type=int, help="Maximum number of distinct pages to load.", default=16)
+    parser.add_argument("--requests", type=int, help="Number of requests to send. Pages are reused if there are fewer pages.", default=64)
+    parser.add_argument("--concurrency", type=int, help="Number of requests in flight at once.", default=8)
+    parser.add_argument("--langs", type=str, help="Language(s) to send with each page. Comma separate for multiple, and semicolon separate sets of languages to cycle through, like en;en,hi.", default="en")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input_path):
+        images, _ = lazy_load_from_folder(args.input_path, args.max)
+    else:
+        images, _ = lazy_load_from_file(args.input_path, args.max)
+    lang_sets = [langs.split(",") for langs in args.langs.split(";")]
+    # Requests with different languages end up in the same server batches
+    encoded = [encode_page(image) for image in images]
+    bodies = [json.dumps({"image": encoded[i % len(encoded)], "langs": lang_sets[i % len(lang_sets)]}).encode() for i in range(max(len(encoded), len(lang_sets)))]
+    print(f"Loaded {len(encoded)} pages.")
+
+    url = urlparse(args.url)
+    connections = threading.local()
+
+    def send(idx):
+        # Each thread keeps its connection open across requests
+        if getattr(connections, "conn", None) is None:
+            connections.conn = http.client.HTTPConnection(url.hostname, url.port)
+        start = time.time()
+        try:
+            connections.conn.request("POST", "/ocr", body=bodies[idx % len(bodies)], headers={"Content-Type": "application/json"})
+            response = connections.conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (http.client.HTTPException, ConnectionError):
+            connections.conn = None
+            ok = False
+        return time.time() - start, ok
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.requests)))
+    total_time = time.time() - start
+
+    latencies = np.array([latency for latency, ok in results if ok])
+    errors = sum([not ok for _, ok in results])
+    out_data = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "time": total_time,
+        "pages_per_sec": len(latencies) / total_time,
+        "p50": float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+        "p99": float(np.percentile(latencies, 99)) if len(latencies) > 0 else None,
+    }
+
+    result_path = os.path.join(args.results_dir, "server")
+    os.makedirs(result_path, exist_ok=True)
+    with open(os.path.join(result_path, "results.json"), "w+") as f:
+        json.dump(out_data, f, indent=4)
+
+    table_headers = ["Requests", "Concurrency", "Errors", "Pages/sec", "p50 latency (s)", "p99 latency (s)"]
+    table_data = [[args.requests, args.concurrency, errors, out_data["pages_per_sec"], out_data["p50"], out_data["p99"]]]
+    print(tabulate(table_data, headers=table_headers, tablefmt="github"))
+    print(f"Wrote results to {result_path}")
+
+    if errors > 0:
+        raise SystemExit(f"{errors} of {args.requests} requests failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
 import argparse
 import copy
 import json
-from collections import defaultdict
+from collections import defaultdict, deque
 
-from surya.input.load import load_from_folder, load_from_file
+from surya import instrumentation
+from surya.input.load import get_input_paths, get_pages, get_shard_paths, get_shard_suffix, lazy_load_pages, parse_shard
 from surya.model.detection.segformer import load_model, load_processor
-from surya.detection import batch_detection
+from surya.detection import batch_detection_iter
 from surya.postprocessing.affinity import draw_lines_on_image
 from surya.postprocessing.heatmap import draw_polys_on_image
 from surya.settings import settings
@@ -15,29 +16,48 @@ from tqdm import tqdm
 
 def main():
     parser = argparse.ArgumentParser(description="Detect bboxes in an input file or folder (PDFs or image).")
-    parser.add_argument("input_path", type=str, help="Path to pdf or image file or folder to detect bboxes in.")
+    parser.add_argument("input_path", type=str, help="Path to pdf or image file or folder to detect bboxes in, or a .txt file listing files.")
     parser.add_argument("--results_dir", type=str, help="Path to JSON file with OCR results.", default=os.path.join(settings.RESULT_DIR, "surya"))
     parser.add_argument("--max", type=int, help="Maximum number of pages to process.", default=None)
     parser.add_argument("--images", action="store_true", help="Save images of detected bboxes.", default=False)
     parser.add_argument("--debug", action="store_true", help="Run in debug mode.", default=False)
+    parser.add_argument("--timings", action="store_true", help="Record how long each pipeline stage takes, and write the stats to timings.json.", default=False)
+    parser.add_argument("--shard", type=str, help="Only process shard i of N, like 0/4. Files are assigned to shards by a hash of their name. Results go to results.shard-i-of-N.json, combine them with merge_results.py.", default=None)
     args = parser.parse_args()
+    if args.timings:
+        instrumentation.enable()
 
     model = load_model()
     processor = load_processor()
 
     if os.path.isdir(args.input_path):
-        images, names = load_from_folder(args.input_path, args.max)
         folder_name = os.path.basename(args.input_path)
     else:
-        images, names = load_from_file(args.input_path, args.max)
         folder_name = os.path.basename(args.input_path).split(".")[0]
 
-    predictions = batch_detection(images, model, processor)
+    paths = get_input_paths(args.input_path)
+    if args.shard:
+        paths = get_shard_paths(paths, *parse_shard(args.shard))
+    # Pages are rendered as they are needed, so large folders don't need to fit in memory
+    images, names = lazy_load_pages(get_pages(paths, args.max))
+
+    # Only hold on to pages until their predictions are drawn
+    drawn_images = deque()
+
+    def page_images():
+        for image in images:
+            if args.images:
+                drawn_images.append(image)
+            yield image
+
+    predictions = tqdm(batch_detection_iter(page_images(), model, processor), total=len(names), desc="Detecting bboxes")
     result_path = os.path.join(args.results_dir, folder_name)
     os.makedirs(result_path, exist_ok=True)
 
-    if args.images:
-        for idx, (image, pred, name) in enumerate(zip(images, predictions, names)):
+    predictions_by_page = defaultdict(list)
+    for idx, (pred, name) in enumerate(zip(predictions, names)):
+        if args.images:
+            image = drawn_images.popleft()
             polygons = [p.polygon for p in pred.bboxes]
             bbox_image = draw_polys_on_image(polygons, copy.deepcopy(image))
             bbox_image.save(os.path.join(result_path, f"{name}_{idx}_bbox.png"))
@@ -52,15 +72,16 @@ def main():
                 affinity_map = pred.affinity_map
                 affinity_map.save(os.path.join(result_path, f"{name}_{idx}_affinity.png"))
 
-    predictions_by_page = defaultdict(list)
-    for idx, (pred, name, image) in enumerate(zip(predictions, names, images)):
         out_pred = pred.model_dump(exclude=["heatmap", "affinity_map"])
         out_pred["page"] = len(predictions_by_page[name]) + 1
         predictions_by_page[name].append(out_pred)
 
-    with open(os.path.join(result_path, "results.json"), "w+") as f:
+    with open(os.path.join(result_path, f"results{get_shard_suffix(args.shard)}.json"), "w+") as f:
         json.dump(predictions_by_page, f, ensure_ascii=False)
 
+    if args.timings:
+        instrumentation.export_json(os.path.join(result_path, f"timings{get_shard_suffix(args.shard)}.json"))
+
     print(f"Wrote results to {result_path}")
 
 
@@ -0,0 +1,32 @@
+import argparse
+
+from surya.input.langs import replace_lang_with_code
+from surya.model.recognition.model import load_model, save_pruned_model
+from surya.model.recognition.processor import load_processor
+from surya.model.recognition.tokenizer import _tokenize
+from surya.settings import settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save a recognition model pruned to a set of languages, with its image processor config. Point RECOGNITION_MODEL_CHECKPOINT at the output folder to use it.")
+    parser.add_argument("output_dir", type=str, help="Folder to save the pruned model to.")
+    parser.add_argument("--langs", type=str, help="Language(s) to keep. Comma separate for multiple. Can be a capitalized language name, or a 2-letter ISO 639 code.", required=True)
+    parser.add_argument("--checkpoint", type=str, help="Recognition model checkpoint to prune.", default=settings.RECOGNITION_MODEL_CHECKPOINT)
+    args = parser.parse_args()
+
+    langs = args.langs.split(",")
+    replace_lang_with_code(langs)
+    _, lang_tokens = _tokenize("", langs)
+
+    model = load_model(checkpoint=args.checkpoint, device="cpu")
+    save_pruned_model(model, args.output_dir, lang_tokens, checkpoint=args.checkpoint)
+
+    # Load the export the same way the pipeline will, so a broken folder fails here instead of at OCR time
+    pruned_model = load_model(checkpoint=args.output_dir, device="cpu", langs=lang_tokens)
+    load_processor(checkpoint=args.output_dir)
+    assert sorted(pruned_model.decoder.config.langs.values()) == sorted(lang_tokens), "Exported model has the wrong languages"
+    print(f"Checked that {args.output_dir} loads.  Set RECOGNITION_MODEL_CHECKPOINT={args.output_dir} to use it.")
+
+
+if __name__ == "__main__":
+    main()
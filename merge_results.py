@@ -0,0 +1,47 @@
+import argparse
+import json
+import os
+import re
+from collections import defaultdict
+
+SHARD_PATTERN = re.compile(r"^results\.shard-(\d+)-of-(\d+)\.json$")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Combine results from ocr_text.py or detect_text.py runs with --shard into one results.json.")
+    parser.add_argument("result_path", type=str, help="Folder with results.shard-i-of-N.json files, like results/surya/<input name>. Copy shard outputs from other machines here first.")
+    parser.add_argument("--allow_missing", action="store_true", help="Merge even if some shards have no results yet.", default=False)
+    args = parser.parse_args()
+
+    shard_files = {}
+    shard_counts = set()
+    for file_name in os.listdir(args.result_path):
+        match = SHARD_PATTERN.match(file_name)
+        if match:
+            shard_idx, shard_count = int(match.group(1)), int(match.group(2))
+            shard_files[shard_idx] = os.path.join(args.result_path, file_name)
+            shard_counts.add(shard_count)
+
+    assert len(shard_counts) == 1, f"Expected results from one sharded run, found shard counts {sorted(shard_counts)}"
+    shard_count = shard_counts.pop()
+    missing = sorted(set(range(shard_count)) - set(shard_files.keys()))
+    if len(missing) > 0:
+        assert args.allow_missing, f"Missing results for shards {missing} of {shard_count}"
+        print(f"Warning: merging without shards {missing} of {shard_count}")
+
+    # Each file is in exactly one shard, so results for a file come from one shard, and keep their page order
+    out_preds = defaultdict(list)
+    for shard_idx in sorted(shard_files.keys()):
+        with open(shard_files[shard_idx], "r") as f:
+            shard_preds = json.load(f)
+        for name, pages in shard_preds.items():
+            out_preds[name].extend(pages)
+
+    with open(os.path.join(args.result_path, "results.json"), "w+") as f:
+        json.dump(out_preds, f, ensure_ascii=False)
+
+    print(f"Merged {len(shard_files)} shards with {sum(len(pages) for pages in out_preds.values())} pages into {args.result_path}")
+
+
+if __name__ == "__main__":
+    main()
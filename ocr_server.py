@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+
+from surya.model.detection.segformer import load_model as load_detection_model, load_processor as load_detection_processor
+from surya.model.recognition.model import load_model as load_recognition_model
+from surya.model.recognition.processor import load_processor as load_recognition_processor
+from surya.server import OCRServer
+from surya.settings import settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve OCR over HTTP, batching pages and line images from concurrent requests together.")
+    parser.add_argument("--host", type=str, help="Host to listen on.", default=settings.SERVER_HOST)
+    parser.add_argument("--port", type=int, help="Port to listen on.", default=settings.SERVER_PORT)
+    parser.add_argument("--max_batch_pages", type=int, help="Maximum pages per batch. Defaults to the detector batch size.", default=settings.SERVER_MAX_BATCH_PAGES)
+    parser.add_argument("--max_batch_lines", type=int, help="Maximum line images per batch. Defaults to the recognition batch size.", default=settings.SERVER_MAX_BATCH_LINES)
+    parser.add_argument("--max_wait_ms", type=int, help="How long a batch waits for more requests before it runs.", default=settings.SERVER_MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    det_processor = load_detection_processor()
+    det_model = load_detection_model()
+    rec_model = load_recognition_model()
+    rec_processor = load_recognition_processor()
+
+    server = OCRServer(det_model, det_processor, rec_model, rec_processor, args.max_batch_pages, args.max_batch_lines, args.max_wait_ms / 1000)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,58 @@ import argparse
 import json
 from collections import defaultdict
 
+from surya import instrumentation
 from surya.input.langs import replace_lang_with_code, get_unique_langs
-from surya.input.load import load_from_folder, load_from_file, load_lang_file
+from surya.checkpoint import JobCheckpoint
+from surya.input.load import get_input_paths, get_name_from_path, get_pages, get_shard_paths, get_shard_suffix, lazy_load_pages, load_lang_file, parse_shard
 from surya.model.detection.segformer import load_model as load_detection_model, load_processor as load_detection_processor
 from surya.model.recognition.model import load_model as load_recognition_model
 from surya.model.recognition.processor import load_processor as load_recognition_processor
 from surya.model.recognition.tokenizer import _tokenize
-from surya.ocr import run_ocr
+from surya.ocr import run_ocr_pipelined
 from surya.postprocessing.text import draw_text_on_image
 from surya.settings import settings
+from surya.workers import run_ocr_parallel
 import os
 
 
 def main():
     parser = argparse.ArgumentParser(description="Detect bboxes in an input file or folder (PDFs or image).")
-    parser.add_argument("input_path", type=str, help="Path to PDF or image file or folder to detect bboxes in.")
+    parser.add_argument("input_path", type=str, help="Path to PDF or image file or folder to detect bboxes in, or a .txt file listing files.")
     parser.add_argument("--results_dir", type=str, help="Path to JSON file with OCR results.", default=os.path.join(settings.RESULT_DIR, "surya"))
     parser.add_argument("--max", type=int, help="Maximum number of pages to process.", default=None)
     parser.add_argument("--start_page", type=int, help="Page to start processing at.", default=0)
     parser.add_argument("--images", action="store_true", help="Save images of detected bboxes.", default=False)
     parser.add_argument("--langs", type=str, help="Language(s) to use for OCR. Comma separate for multiple. Can be a capitalized language name, or a 2-letter ISO 639 code.", default=None)
     parser.add_argument("--lang_file", type=str, help="Path to file with languages to use for OCR. Should be a JSON dict with file names as keys, and the value being a list of language codes/names.", default=None)
+    parser.add_argument("--checkpoint", action="store_true", help="Write results for each page to results.jsonl as it finishes, and skip finished pages if the job is restarted.", default=False)
+    parser.add_argument("--shard", type=str, help="Only process shard i of N, like 0/4. Files are assigned to shards by a hash of their name. Results go to results.shard-i-of-N.json, combine them with merge_results.py.", default=None)
+    parser.add_argument("--timings", action="store_true", help="Record how long each pipeline stage takes (in this process only, not --workers), and write the stats to timings.json.", default=False)
+    parser.add_argument("--workers", type=int, help="Number of processes to run OCR in. Helps on CPU hosts with many cores.", default=settings.OCR_WORKERS)
     args = parser.parse_args()
 
     assert args.langs or args.lang_file, "Must provide either --langs or --lang_file"
+    if args.timings:
+        instrumentation.enable()
 
     if os.path.isdir(args.input_path):
-        images, names = load_from_folder(args.input_path, args.max, args.start_page)
         folder_name = os.path.basename(args.input_path)
     else:
-        images, names = load_from_file(args.input_path, args.max, args.start_page)
         folder_name = os.path.basename(args.input_path).split(".")[0]
 
+    paths = get_input_paths(args.input_path)
+    if args.shard:
+        paths = get_shard_paths(paths, *parse_shard(args.shard))
+    pages = get_pages(paths, args.max, args.start_page)
+    names = [get_name_from_path(path) for path, _ in pages]
+
+    # Page numbers within each file, counted before any pages are skipped
+    page_numbers = []
+    page_counts = defaultdict(int)
+    for name in names:
+        page_counts[name] += 1
+        page_numbers.append(page_counts[name])
+
     if args.lang_file:
         # We got all of our language settings from a file
         langs = load_lang_file(args.lang_file, names)
@@ -44,41 +64,69 @@ def main():
         # We got our language settings from the input
         langs = args.langs.split(",")
         replace_lang_with_code(langs)
-        image_langs = [langs] * len(images)
-
-    # Load models and processors
-    det_processor = load_detection_processor()
-    det_model = load_detection_model()
+        image_langs = [langs] * len(names)
 
     _, lang_tokens = _tokenize("", get_unique_langs(image_langs))
-    rec_model = load_recognition_model(langs=lang_tokens)  # Prune model moe layer to only include languages we need
-    rec_processor = load_recognition_processor()
 
     result_path = os.path.join(args.results_dir, folder_name)
     os.makedirs(result_path, exist_ok=True)
 
-    # Run OCR on all loaded images
-    predictions_by_image = run_ocr(images, image_langs, det_model, det_processor, rec_model, rec_processor)
+    checkpoint = None
+    todo = list(range(len(pages)))
+    if args.checkpoint:
+        checkpoint = JobCheckpoint(result_path, get_shard_suffix(args.shard))
+        todo = [idx for idx, (path, page_idx) in enumerate(pages) if not checkpoint.is_done(path, page_idx)]
+        print(f"Skipping {len(pages) - len(todo)} pages finished by an earlier run")
+
+    # Pages are rendered as they are needed, so large folders don't need to fit in memory
+    images, _ = lazy_load_pages([pages[idx] for idx in todo])
+    todo_langs = [image_langs[idx] for idx in todo]
+
+    if args.workers > 1:
+        # Models are loaded once, and shared with the workers on CPU
+        predictions_by_image = run_ocr_parallel(images, todo_langs, workers=args.workers, rec_langs=lang_tokens)
+    else:
+        # Load models and processors
+        det_processor = load_detection_processor()
+        det_model = load_detection_model()
+
+        rec_model = load_recognition_model(langs=lang_tokens)  # Prune model moe layer to only include languages we need
+        rec_processor = load_recognition_processor()
 
-    # Save images with detected text if requested
-    if args.images:
-        for idx, (name, image, pred) in enumerate(zip(names, images, predictions_by_image)):
+        # Run OCR on all loaded images
+        predictions_by_image = run_ocr_pipelined(images, todo_langs, det_model, det_processor, rec_model, rec_processor)
+
+    # Organize predictions by image name
+    out_preds = defaultdict(list)
+    for idx, pred in zip(todo, predictions_by_image):
+        name = names[idx]
+        # Save images with detected text if requested
+        if args.images:
             bboxes = [l.bbox for l in pred.text_lines]
             pred_text = [l.text for l in pred.text_lines]
-            page_image = draw_text_on_image(bboxes, pred_text, image.size)
+            image_size = (int(pred.image_bbox[2]), int(pred.image_bbox[3]))
+            page_image = draw_text_on_image(bboxes, pred_text, image_size)
             page_image.save(os.path.join(result_path, f"{name}_{idx}_text.png"))
 
-    # Organize predictions by image name
-    out_preds = defaultdict(list)
-    for name, pred, image in zip(names, predictions_by_image, images):
         out_pred = pred.model_dump()
-        out_pred["page"] = len(out_preds[name]) + 1
-        out_preds[name].append(out_pred)
+        out_pred["page"] = page_numbers[idx]
+        if checkpoint is not None:
+            checkpoint.add(*pages[idx], name, out_pred)
+        else:
+            out_preds[name].append(out_pred)
+
+    if checkpoint is not None:
+        # Includes pages from earlier runs
+        out_preds = checkpoint.collect(pages)
+        checkpoint.close()
 
     # Write results to JSON file
-    with open(os.path.join(result_path, "results.json"), "w+") as f:
+    with open(os.path.join(result_path, f"results{get_shard_suffix(args.shard)}.json"), "w+") as f:
         json.dump(out_preds, f, ensure_ascii=False)
 
+    if args.timings:
+        instrumentation.export_json(os.path.join(result_path, f"timings{get_shard_suffix(args.shard)}.json"))
+
     print(f"Wrote results to {result_path}")
 
 
@@ -1,6 +1,5 @@
 from cog import BasePredictor, Input, Path, BaseModel
 from PIL import Image
-import pypdfium2
 import json
 from typing import List
 from surya.detection import batch_detection
@@ -12,13 +11,18 @@ from surya.ocr import run_ocr
 from surya.postprocessing.text import draw_text_on_image
 from surya.languages import CODE_TO_LANGUAGE
 from surya.input.langs import replace_lang_with_code
+from surya.input.render import PdfPageCache
 from surya.schema import OCRResult, DetectionResult
+from surya.settings import settings
 import tempfile  # For handling temporary file creation
 
 # Load models and processors globally to reuse them efficiently
 det_model, det_processor = load_model(), load_processor()
 rec_model, rec_processor = load_rec_model(), load_rec_processor()
 
+# Only the requested page is rendered, and repeat requests for the same file reuse open documents and rendered pages
+pdf_cache = PdfPageCache(settings.PDF_DOC_CACHE_SIZE, settings.PDF_PAGE_CACHE_SIZE)
+
 def text_detection(img) -> DetectionResult:
     pred = batch_detection([img], det_model, det_processor)[0]
     polygons = [p.polygon for p in pred.bboxes]
@@ -35,22 +39,8 @@ def ocr(img, langs) -> OCRResult:
     rec_img = draw_text_on_image(bboxes, text, img.size)
     return rec_img, img_pred
 
-def open_pdf(pdf_file_path):
-    return pypdfium2.PdfDocument(pdf_file_path)
-
-def get_all_page_images(pdf_file_path, dpi=96):
-    doc = open_pdf(pdf_file_path)
-    images = []
-    for page_index in range(len(doc)):
-        renderer = doc.render(
-            pypdfium2.PdfBitmap.to_pil,
-            page_indices=[page_index],
-            scale=dpi / 72,
-        )
-        png = list(renderer)[0]
-        png_image = png.convert("RGB")
-        images.append(png_image)
-    return images
+def get_page_image(pdf_file_path, page_number, dpi=96):
+    return pdf_cache.render(pdf_file_path, page_number - 1, dpi)
 
 def handle_input(file_info, page_number, languages, action):
     if file_info is None:
@@ -58,8 +48,7 @@ def handle_input(file_info, page_number, languages, action):
     
     filetype = file_info.name.split('.')[-1].lower()
     if filetype == 'pdf':
-        pil_images = get_all_page_images("/tmp/" + file_info.name)
-        pil_image = pil_images[page_number - 1]  # Handle specific page or all pages
+        pil_image = get_page_image("/tmp/" + file_info.name, page_number)
     else:
         pil_image = Image.open("/tmp/" + file_info.name).convert("RGB")
       
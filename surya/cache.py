@@ -0,0 +1,317 @@
+import atexit
+import base64
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+from PIL import Image
+
+from surya.schema import DetectionResult, OCRResult
+from surya.settings import settings
+
+# Bump when cached results would no longer match what the code produces
+CACHE_VERSION = 1
+RESULT_CLASSES = {
+    "detection": DetectionResult,
+    "ocr": OCRResult,
+}
+# Heatmaps are stored as png, everything else as json
+IMAGE_FIELDS = ["heatmap", "affinity_map"]
+
+
+def image_hash(image: Image.Image) -> str:
+    sha = hashlib.sha256()
+    sha.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+def model_id(model) -> str:
+    config = getattr(model, "config", None)
+    return f"{getattr(config, 'name_or_path', '')}:{getattr(model, 'dtype', '')}"
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha256(json.dumps([CACHE_VERSION, *parts], default=str).encode()).hexdigest()
+
+
+def detection_key(image: Image.Image, det_model) -> str:
+    return make_key(
+        "detection",
+        image_hash(image),
+        model_id(det_model),
+        settings.DETECTOR_IMAGE_CHUNK_HEIGHT,
+        settings.DETECTOR_TEXT_THRESHOLD,
+        settings.DETECTOR_BLANK_THRESHOLD,
+    )
+
+
+def ocr_key(image: Image.Image, langs, det_model, rec_model) -> str:
+    return make_key(
+        "ocr",
+        detection_key(image, det_model),
+        list(langs),
+        model_id(rec_model),
+        settings.RECOGNITION_MAX_TOKENS,
+        settings.RECOGNITION_IMAGE_SIZE,
+    )
+
+
+def line_key(image: Image.Image, langs, rec_model) -> str:
+    # Lines are hashed after conversion to RGB, which is what the model sees
+    sha = hashlib.blake2b(digest_size=16)
+    sha.update(f"{image.size[0]}x{image.size[1]}:{','.join(langs)}:{model_id(rec_model)}:{settings.RECOGNITION_MAX_TOKENS}".encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+def encode_image(image: Image.Image) -> str:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def decode_image(data: str) -> Image.Image:
+    image = Image.open(io.BytesIO(base64.b64decode(data)))
+    image.load()
+    return image
+
+
+class ResultCache:
+    # Stores results on disk, one compressed file per key.  Least recently used files are evicted once the cache
+    # is over max_size bytes.  Recency is kept in file mtimes, so it survives restarts and is shared between processes.
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.endswith(".json.z") and os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+        # Least recently used first
+        self.entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self.total_size = sum(self.entries.values())
+
+    def path(self, kind: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{kind}_{key}.json.z")
+
+    def get(self, kind: str, key: str) -> Optional[Union[DetectionResult, OCRResult]]:
+        path = self.path(kind, key)
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()))
+            os.utime(path)
+        except (OSError, ValueError, zlib.error):
+            # Missing, evicted by another process, or partially written
+            with self.lock:
+                self.misses[kind] += 1
+            return None
+
+        for field in IMAGE_FIELDS:
+            if data.get(field) is not None:
+                data[field] = decode_image(data[field])
+
+        with self.lock:
+            self.hits[kind] += 1
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        return RESULT_CLASSES[kind](**data)
+
+    def put(self, kind: str, key: str, result: Union[DetectionResult, OCRResult]):
+        data = result.model_dump(exclude=IMAGE_FIELDS)
+        for field in IMAGE_FIELDS:
+            image = getattr(result, field, None)
+            if image is not None:
+                data[field] = encode_image(image)
+        payload = zlib.compress(json.dumps(data, ensure_ascii=False).encode())
+
+        # Write to a temp file first, so readers never see a partial entry
+        path = self.path(kind, key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_size += len(payload) - self.entries.pop(path, 0)
+            self.entries[path] = len(payload)
+            self.evict()
+
+    def evict(self):
+        while self.total_size > self.max_size and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "entries": len(self.entries),
+                "size": self.total_size,
+            }
+
+    def cached_iter(self, kind: str, items: Iterable, key_fn: Callable, compute_fn: Callable[[Iterator], Iterator]) -> Iterator:
+        # Yields results for items in order.  compute_fn gets an iterator over the items that weren't cached, and must
+        # yield one result per item, in order.  Misses are streamed, so this works with lazy inputs.
+        order = deque()
+
+        def misses():
+            for item in items:
+                key = key_fn(item)
+                result = self.get(kind, key)
+                order.append((key, result))
+                if result is None:
+                    yield item
+
+        for result in compute_fn(misses()):
+            while order[0][1] is not None:
+                yield order.popleft()[1]
+            key, _ = order.popleft()
+            self.put(kind, key, result)
+            yield result
+
+        # Only cached results are left
+        while len(order) > 0:
+            yield order.popleft()[1]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    global _cache
+    if settings.RESULT_CACHE_DIR is None:
+        return None
+
+    with _cache_lock:
+        if _cache is None or _cache.cache_dir != settings.RESULT_CACHE_DIR:
+            _cache = ResultCache(settings.RESULT_CACHE_DIR, settings.RESULT_CACHE_MAX_SIZE * 1024 * 1024)
+        return _cache
+
+
+class LineCache:
+    # Recognized text for line images.  The most recent max_size lines are kept in memory, and lines evicted from
+    # memory spill to an sqlite db in cache_dir if set, which keeps up to max_disk_size lines.
+    def __init__(self, max_size: int, cache_dir: Optional[str] = None, max_disk_size: int = 0):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.max_disk_size = max_disk_size
+        self.lines = OrderedDict()
+        self.spilled = {}  # Evicted from memory, but not written to disk yet
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(cache_dir, "lines.db"), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS lines (key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used INTEGER NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS lines_last_used ON lines (last_used)")
+            self.db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            text = self.lines.get(key)
+            if text is not None:
+                self.lines.move_to_end(key)
+            elif key in self.spilled:
+                text = self.spilled.pop(key)
+                self.add(key, text)
+            elif self.db is not None:
+                row = self.db.execute("SELECT text FROM lines WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    text = row[0]
+                    self.add(key, text)
+
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return text
+
+    def put(self, key: str, text: str):
+        with self.lock:
+            self.add(key, text)
+
+    def add(self, key: str, text: str):
+        self.lines[key] = text
+        self.lines.move_to_end(key)
+        while len(self.lines) > self.max_size:
+            evicted_key, evicted_text = self.lines.popitem(last=False)
+            if self.db is not None:
+                self.spilled[evicted_key] = evicted_text
+
+    def flush(self):
+        # Writes lines evicted from memory to disk, then trims the db to max_disk_size
+        with self.lock:
+            if self.db is None or len(self.spilled) == 0:
+                return
+
+            now = time.time_ns()
+            self.db.executemany(
+                "INSERT OR REPLACE INTO lines (key, text, last_used) VALUES (?, ?, ?)",
+                [(key, text, now + i) for i, (key, text) in enumerate(self.spilled.items())]
+            )
+            self.spilled = {}
+            self.db.execute(
+                "DELETE FROM lines WHERE key IN (SELECT key FROM lines ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_size,)
+            )
+            self.db.commit()
+
+    def close(self):
+        # Everything in memory is written to disk, so the next run can reuse it
+        if self.db is None:
+            return
+        with self.lock:
+            self.spilled.update(self.lines)
+        self.flush()
+        with self.lock:
+            self.db.close()
+            self.db = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.lines),
+            }
+
+
+_line_cache = None
+
+
+def get_line_cache() -> Optional[LineCache]:
+    global _line_cache
+    if settings.RECOGNITION_LINE_CACHE_SIZE <= 0:
+        return None
+
+    with _cache_lock:
+        if _line_cache is None or _line_cache.max_size != settings.RECOGNITION_LINE_CACHE_SIZE or _line_cache.cache_dir != settings.RECOGNITION_LINE_CACHE_DIR:
+            if _line_cache is not None:
+                _line_cache.close()
+            _line_cache = LineCache(settings.RECOGNITION_LINE_CACHE_SIZE, settings.RECOGNITION_LINE_CACHE_DIR, settings.RECOGNITION_LINE_CACHE_DISK_SIZE)
+            atexit.register(_line_cache.close)
+        return _line_cache
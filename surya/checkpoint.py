@@ -0,0 +1,83 @@
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+
+def page_key(path: str, page_idx: Optional[int]) -> str:
+    # Files are identified by name, so a job can be resumed from another directory or machine.  get_input_paths
+    # makes sure names are unique.
+    return f"{os.path.basename(path)}:{page_idx}"
+
+
+def read_jsonl(path: str) -> List[dict]:
+    # Skips lines that can't be parsed, like the last line if a run was killed while writing it
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def write_jsonl(path: str, records: List[dict]):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+class JobCheckpoint:
+    # Appends the result for each page to results.jsonl as soon as it finishes, then marks the page done in
+    # manifest.jsonl.  When a job restarts, pages in the manifest are skipped.  Shards add a suffix to both files.
+    def __init__(self, result_path: str, suffix: str = ""):
+        self.results_path = os.path.join(result_path, f"results{suffix}.jsonl")
+        self.manifest_path = os.path.join(result_path, f"manifest{suffix}.jsonl")
+
+        # Only results for pages in the manifest are kept, so a page that was cut off mid-write is redone
+        self.done = set(record["key"] for record in read_jsonl(self.manifest_path) if "key" in record)
+        results = {}
+        for record in read_jsonl(self.results_path):
+            if record.get("key") in self.done:
+                results[record["key"]] = record
+        self.done = set(results.keys())
+
+        # Rewrite both files, so appends never follow a partial line
+        write_jsonl(self.results_path, list(results.values()))
+        write_jsonl(self.manifest_path, [{"key": key} for key in results.keys()])
+        self.results_file = open(self.results_path, "a", encoding="utf-8")
+        self.manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+
+    def is_done(self, path: str, page_idx: Optional[int]) -> bool:
+        return page_key(path, page_idx) in self.done
+
+    def append(self, f, record: dict):
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def add(self, path: str, page_idx: Optional[int], name: str, result: dict):
+        key = page_key(path, page_idx)
+        self.append(self.results_file, {"key": key, "name": name, "result": result})
+        self.append(self.manifest_file, {"key": key})
+        self.done.add(key)
+
+    def collect(self, pages: List[Tuple[str, Optional[int]]]) -> Dict[str, List[dict]]:
+        # Results for all finished pages, by name, in page order
+        results = {record["key"]: record for record in read_jsonl(self.results_path)}
+        out_preds = defaultdict(list)
+        for path, page_idx in pages:
+            record = results.get(page_key(path, page_idx))
+            if record is not None:
+                out_preds[record["name"]].append(record["result"])
+        return out_preds
+
+    def close(self):
+        self.results_file.close()
+        self.manifest_file.close()
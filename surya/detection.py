@@ -1,11 +1,16 @@
-from typing import List
+import itertools
+from collections import deque
+from typing import List, Iterable, Iterator, Optional, Tuple
 
 import cv2
 import torch
 import numpy as np
 from PIL import Image
-from surya.postprocessing.heatmap import get_and_clean_boxes
+from surya.postprocessing.heatmap import get_and_clean_boxes, get_dynamic_thresholds_batch
 from surya.postprocessing.affinity import get_vertical_lines, get_horizontal_lines
+from surya.cache import detection_key, get_result_cache
+from surya.input.prefetch import parallel_map, prefetch
+from surya.instrumentation import span
 from surya.input.processing import prepare_image, split_image
 from surya.schema import DetectionResult
 from surya.settings import settings
@@ -21,98 +26,139 @@ def get_batch_size():
     return batch_size
 
 
-def batch_detection(images: List, model, processor) -> List[DetectionResult]:
-    assert all([isinstance(image, Image.Image) for image in images])
-    batch_size = get_batch_size()
+def get_page_splits(image: Image.Image, processor):
+    with span("split"):
+        image = image.convert("RGB")
+        image_parts, split_heights = split_image(image, processor)
+    with span("prepare_image", items=len(image_parts)):
+        image_parts = [prepare_image(part, processor) for part in image_parts]
+    return image.size, image_parts, split_heights
+
 
-    images = [image.convert("RGB") for image in images]
-    orig_sizes = [image.size for image in images]
-    split_index = []
-    split_heights = []
-    image_splits = []
-    for i, image in enumerate(images):
-        image_parts, split_height = split_image(image, processor)
-        image_splits.extend(image_parts)
-        split_index.extend([i] * len(image_parts))
-        split_heights.extend(split_height)
+def run_detection_model(batch: List[torch.Tensor], model, processor) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # Batch images in dim 0
+    batch = torch.stack(batch, dim=0)
+    batch = batch.to(model.dtype)
+    batch = batch.to(model.device)
 
-    image_splits = [prepare_image(image, processor) for image in image_splits]
+    with torch.inference_mode(), span("detection_forward", items=len(batch), sync=True):
+        pred = model(pixel_values=batch)
 
+    logits = pred.logits
     pred_parts = []
-    for i in tqdm(range(0, len(image_splits), batch_size), desc="Detecting bboxes"):
-        batch = image_splits[i:i+batch_size]
-        # Batch images in dim 0
-        batch = torch.stack(batch, dim=0)
-        batch = batch.to(model.dtype)
-        batch = batch.to(model.device)
-
-        with torch.inference_mode():
-            pred = model(pixel_values=batch)
-
-        logits = pred.logits
-        for j in range(logits.shape[0]):
-            heatmap = logits[j, 0, :, :].detach().cpu().numpy().astype(np.float32)
-            affinity_map = logits[j, 1, :, :].detach().cpu().numpy().astype(np.float32)
-
-            heatmap_shape = list(heatmap.shape)
-            correct_shape = [processor.size["height"], processor.size["width"]]
-            cv2_size = list(reversed(correct_shape)) # opencv uses (width, height) instead of (height, width)
-
-            if heatmap_shape != correct_shape:
-                heatmap = cv2.resize(heatmap, cv2_size, interpolation=cv2.INTER_LINEAR)
-
-            affinity_shape = list(affinity_map.shape)
-            if affinity_shape != correct_shape:
-                affinity_map = cv2.resize(affinity_map, cv2_size, interpolation=cv2.INTER_LINEAR)
-
-            pred_parts.append((heatmap, affinity_map))
-
-    preds = []
-    for i, (idx, height) in enumerate(zip(split_index, split_heights)):
-        if len(preds) <= idx:
-            preds.append(pred_parts[i])
-        else:
-            heatmap, affinity_map = preds[idx]
-            pred_heatmap = pred_parts[i][0]
-            pred_affinity = pred_parts[i][1]
-
-            if height < processor.size["height"]:
-                # Cut off padding to get original height
-                pred_heatmap = pred_heatmap[:height, :]
-                pred_affinity = pred_affinity[:height, :]
-
-            heatmap = np.vstack([heatmap, pred_heatmap])
-            affinity_map = np.vstack([affinity_map, pred_affinity])
-            preds[idx] = (heatmap, affinity_map)
-
-    assert len(preds) == len(images)
-    results = []
-    for i in range(len(images)):
-        heatmap, affinity_map = preds[i]
-        heat_img = Image.fromarray((heatmap * 255).astype(np.uint8))
-        aff_img = Image.fromarray((affinity_map * 255).astype(np.uint8))
+    for j in range(logits.shape[0]):
+        heatmap = logits[j, 0, :, :].detach().cpu().numpy().astype(np.float32)
+        affinity_map = logits[j, 1, :, :].detach().cpu().numpy().astype(np.float32)
 
-        affinity_size = list(reversed(affinity_map.shape))
-        heatmap_size = list(reversed(heatmap.shape))
-        bboxes = get_and_clean_boxes(heatmap, heatmap_size, orig_sizes[i])
-        vertical_lines = get_vertical_lines(affinity_map, affinity_size, orig_sizes[i])
-        horizontal_lines = get_horizontal_lines(affinity_map, affinity_size, orig_sizes[i])
+        heatmap_shape = list(heatmap.shape)
+        correct_shape = [processor.size["height"], processor.size["width"]]
+        cv2_size = list(reversed(correct_shape)) # opencv uses (width, height) instead of (height, width)
 
-        result = DetectionResult(
-            bboxes=bboxes,
-            vertical_lines=vertical_lines,
-            horizontal_lines=horizontal_lines,
-            heatmap=heat_img,
-            affinity_map=aff_img,
-            image_bbox=[0, 0, orig_sizes[i][0], orig_sizes[i][1]]
-        )
+        if heatmap_shape != correct_shape:
+            heatmap = cv2.resize(heatmap, cv2_size, interpolation=cv2.INTER_LINEAR)
 
-        results.append(result)
+        affinity_shape = list(affinity_map.shape)
+        if affinity_shape != correct_shape:
+            affinity_map = cv2.resize(affinity_map, cv2_size, interpolation=cv2.INTER_LINEAR)
 
-    return results
+        pred_parts.append((heatmap, affinity_map))
+    return pred_parts
 
 
+def stitch_page_parts(pred_parts: List[Tuple[np.ndarray, np.ndarray]], split_heights: List[int], processor) -> Tuple[np.ndarray, np.ndarray]:
+    heatmap, affinity_map = pred_parts[0]
+    for (pred_heatmap, pred_affinity), height in zip(pred_parts[1:], split_heights[1:]):
+        if height < processor.size["height"]:
+            # Cut off padding to get original height
+            pred_heatmap = pred_heatmap[:height, :]
+            pred_affinity = pred_affinity[:height, :]
 
+        heatmap = np.vstack([heatmap, pred_heatmap])
+        affinity_map = np.vstack([affinity_map, pred_affinity])
+    return heatmap, affinity_map
 
 
+def parse_page_result(heatmap: np.ndarray, affinity_map: np.ndarray, orig_size, thresholds: Optional[Tuple[float, float]] = None) -> DetectionResult:
+    with span("heatmap_image"):
+        heat_img = Image.fromarray((heatmap * 255).astype(np.uint8))
+        aff_img = Image.fromarray((affinity_map * 255).astype(np.uint8))
+
+    affinity_size = list(reversed(affinity_map.shape))
+    heatmap_size = list(reversed(heatmap.shape))
+    with span("line_finding"):
+        bboxes = get_and_clean_boxes(heatmap, heatmap_size, orig_size, thresholds)
+        vertical_lines = get_vertical_lines(affinity_map, affinity_size, orig_size)
+        horizontal_lines = get_horizontal_lines(affinity_map, affinity_size, orig_size)
+
+    return DetectionResult(
+        bboxes=bboxes,
+        vertical_lines=vertical_lines,
+        horizontal_lines=horizontal_lines,
+        heatmap=heat_img,
+        affinity_map=aff_img,
+        image_bbox=[0, 0, orig_size[0], orig_size[1]]
+    )
+
+
+def batch_detection_iter(images: Iterable[Image.Image], model, processor) -> Iterator[DetectionResult]:
+    cache = get_result_cache()
+    if cache is None or not settings.RESULT_CACHE_DETECTION:
+        return run_batch_detection_iter(images, model, processor)
+
+    # Only pages that aren't cached go through the model
+    return cache.cached_iter(
+        "detection",
+        images,
+        lambda image: detection_key(image, model),
+        lambda uncached: run_batch_detection_iter(uncached, model, processor)
+    )
+
+
+def run_batch_detection_iter(images: Iterable[Image.Image], model, processor) -> Iterator[DetectionResult]:
+    # Yields results in input order, holding about one model batch of splits (plus the pages they belong to) in memory,
+    # and the next batch of pages while it is being preprocessed
+    batch_size = get_batch_size()
+    images = iter(images)
+
+    def split_pages(page_images):
+        assert all([isinstance(image, Image.Image) for image in page_images])
+        return parallel_map(lambda image: get_page_splits(image, processor), page_images)
+
+    # Pages are split and resized in parallel, a batch ahead of the model
+    page_chunks = iter(lambda: list(itertools.islice(images, batch_size)), [])
+    page_splits = itertools.chain.from_iterable(prefetch(split_pages, page_chunks))
+
+    pages = deque() # Pages that have been split, but not fully run through the model yet
+    pending_splits = deque() # (page, split) pairs waiting for a model batch
+    for splits in itertools.chain(page_splits, [None]):
+        if splits is not None:
+            orig_size, image_parts, split_heights = splits
+            page = {"orig_size": orig_size, "split_heights": split_heights, "pred_parts": [], "num_parts": len(image_parts)}
+            pages.append(page)
+            pending_splits.extend((page, part) for part in image_parts)
+
+        # Run full batches as soon as they are available, and flush the remainder at the end
+        while len(pending_splits) >= batch_size or (splits is None and len(pending_splits) > 0):
+            batch = [pending_splits.popleft() for _ in range(min(batch_size, len(pending_splits)))]
+            pred_parts = run_detection_model([part for _, part in batch], model, processor)
+            for (page, _), pred_part in zip(batch, pred_parts):
+                page["pred_parts"].append(pred_part)
+
+            finished_pages = []
+            while len(pages) > 0 and len(pages[0]["pred_parts"]) == pages[0]["num_parts"]:
+                finished_pages.append(pages.popleft())
+            if len(finished_pages) == 0:
+                continue
+
+            with span("heatmap_postprocess", items=len(finished_pages)):
+                stitched = [stitch_page_parts(page["pred_parts"], page["split_heights"], processor) for page in finished_pages]
+                thresholds = get_dynamic_thresholds_batch([heatmap for heatmap, _ in stitched], settings.DETECTOR_TEXT_THRESHOLD, settings.DETECTOR_BLANK_THRESHOLD)
+            for page, (heatmap, affinity_map), page_thresholds in zip(finished_pages, stitched, thresholds):
+                yield parse_page_result(heatmap, affinity_map, page["orig_size"], page_thresholds)
+
 
+def batch_detection(images: List, model, processor) -> List[DetectionResult]:
+    assert all([isinstance(image, Image.Image) for image in images])
+    results = list(tqdm(batch_detection_iter(images, model, processor), total=len(images), desc="Detecting bboxes"))
+    assert len(results) == len(images)
+    return results
@@ -1,4 +1,10 @@
+import hashlib
+from collections import Counter
+from typing import Iterator, List, Optional, Tuple
+
 from surya.input.processing import open_pdf, get_page_images
+from surya.input.render import render_pages
+from surya.settings import settings
 import os
 import filetype
 from PIL import Image
@@ -9,9 +15,8 @@ def get_name_from_path(path):
     return os.path.basename(path).split(".")[0]
 
 
-def load_pdf(pdf_path, max_pages=None, start_page=None):
-    doc = open_pdf(pdf_path)
-    last_page = len(doc)
+def get_page_indices(page_count, max_pages=None, start_page=None) -> List[int]:
+    last_page = page_count
 
     if start_page:
         assert start_page < last_page and start_page >= 0, f"Start page must be between 0 and {last_page}"
@@ -22,7 +27,12 @@ def load_pdf(pdf_path, max_pages=None, start_page=None):
         assert max_pages >= 0, f"Max pages must be greater than 0"
         last_page = min(start_page + max_pages, last_page)
 
-    page_indices = list(range(start_page, last_page))
+    return list(range(start_page, last_page))
+
+
+def load_pdf(pdf_path, max_pages=None, start_page=None):
+    doc = open_pdf(pdf_path)
+    page_indices = get_page_indices(len(doc), max_pages, start_page)
     images = get_page_images(doc, page_indices)
     doc.close()
     names = [get_name_from_path(pdf_path) for _ in page_indices]
@@ -44,8 +54,7 @@ def load_from_file(input_path, max_pages=None, start_page=None):
 
 
 def load_from_folder(folder_path, max_pages=None, start_page=None):
-    image_paths = [os.path.join(folder_path, image_name) for image_name in os.listdir(folder_path) if not image_name.startswith(".")]
-    image_paths = [ip for ip in image_paths if not os.path.isdir(ip)]
+    image_paths = get_folder_paths(folder_path)
 
     images = []
     names = []
@@ -61,6 +70,98 @@ def load_from_folder(folder_path, max_pages=None, start_page=None):
     return images, names
 
 
+def get_folder_paths(folder_path) -> List[str]:
+    paths = [os.path.join(folder_path, image_name) for image_name in os.listdir(folder_path) if not image_name.startswith(".")]
+    return [path for path in paths if not os.path.isdir(path)]
+
+
+def get_file_pages(input_path, max_pages=None, start_page=None) -> List[Tuple[str, Optional[int]]]:
+    # (path, page index) for each page to load, with None as the index for images
+    if filetype.guess(input_path).extension == "pdf":
+        doc = open_pdf(input_path)
+        page_count = len(doc)
+        doc.close()
+        return [(input_path, page_idx) for page_idx in get_page_indices(page_count, max_pages, start_page)]
+    return [(input_path, None)]
+
+
+def get_render_workers() -> int:
+    workers = settings.PDF_RENDER_WORKERS
+    if workers is None:
+        workers = min(os.cpu_count() or 1, 8)
+    return workers
+
+
+def lazy_load_pages(pages: List[Tuple[str, Optional[int]]]) -> Tuple[Iterator[Image.Image], List[str]]:
+    # Pages are rendered on demand by a pool of processes, so they don't all need to fit in memory
+    images = render_pages(pages, settings.IMAGE_DPI, get_render_workers(), settings.PDF_RENDER_PREFETCH)
+    names = [get_name_from_path(path) for path, _ in pages]
+    return images, names
+
+
+def lazy_load_from_file(input_path, max_pages=None, start_page=None) -> Tuple[Iterator[Image.Image], List[str]]:
+    return lazy_load_pages(get_file_pages(input_path, max_pages, start_page))
+
+
+def get_list_paths(list_path) -> List[str]:
+    # One path per line, relative paths are relative to the list file
+    list_dir = os.path.dirname(os.path.abspath(list_path))
+    with open(list_path, "r") as f:
+        lines = [line.strip() for line in f]
+    paths = [os.path.join(list_dir, line) for line in lines if line and not line.startswith("#")]
+
+    # Results, checkpoints and shards are keyed by file name, so files with the same name would overwrite each other
+    name_counts = Counter(os.path.basename(path) for path in paths)
+    duplicates = sorted(name for name, count in name_counts.items() if count > 1)
+    assert len(duplicates) == 0, f"Files in {list_path} must have unique names, found several of {', '.join(duplicates)}"
+    return paths
+
+
+def get_input_paths(input_path) -> List[str]:
+    # A folder, a .txt file listing files, or a single file
+    if os.path.isdir(input_path):
+        return get_folder_paths(input_path)
+    if input_path.endswith(".txt"):
+        return get_list_paths(input_path)
+    return [input_path]
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    shard_idx, shard_count = [int(part) for part in shard.split("/")]
+    assert 0 <= shard_idx < shard_count, f"Shard must be i/N with 0 <= i < N, got {shard}"
+    return shard_idx, shard_count
+
+
+def get_shard_paths(paths: List[str], shard_idx: int, shard_count: int) -> List[str]:
+    # Files are assigned by a hash of their name, so every machine picks the same files without coordinating,
+    # regardless of listing order or where the files are mounted
+    def get_shard(path):
+        return int(hashlib.sha256(os.path.basename(path).encode()).hexdigest(), 16) % shard_count
+    return [path for path in paths if get_shard(path) == shard_idx]
+
+
+def get_shard_suffix(shard: Optional[str]) -> str:
+    if shard is None:
+        return ""
+    shard_idx, shard_count = parse_shard(shard)
+    return f".shard-{shard_idx}-of-{shard_count}"
+
+
+def get_pages(paths: List[str], max_pages=None, start_page=None) -> List[Tuple[str, Optional[int]]]:
+    pages = []
+    for path in paths:
+        pages.extend(get_file_pages(path, max_pages, start_page))
+    return pages
+
+
+def get_folder_pages(folder_path, max_pages=None, start_page=None) -> List[Tuple[str, Optional[int]]]:
+    return get_pages(get_folder_paths(folder_path), max_pages, start_page)
+
+
+def lazy_load_from_folder(folder_path, max_pages=None, start_page=None) -> Tuple[Iterator[Image.Image], List[str]]:
+    return lazy_load_pages(get_folder_pages(folder_path, max_pages, start_page))
+
+
 def load_lang_file(lang_path, names):
     with open(lang_path, "r") as f:
         lang_dict = json.load(f)
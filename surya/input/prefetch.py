@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from surya.settings import settings
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker_state = threading.local()
+
+
+def get_preprocessing_workers() -> int:
+    workers = settings.PREPROCESSING_WORKERS
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(workers, 1)
+
+
+def _mark_worker():
+    _worker_state.in_pool = True
+
+
+def get_preprocessing_pool() -> Optional[ThreadPoolExecutor]:
+    # Shared by detection and recognition preprocessing.  PIL releases the GIL while resampling, so threads scale.
+    global _pool
+    workers = get_preprocessing_workers()
+    if workers == 1:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool._max_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="surya-preprocess", initializer=_mark_worker)
+        return _pool
+
+
+def parallel_map(fn: Callable, items: List) -> List:
+    # Runs fn over items on the preprocessing pool, and returns results in order
+    pool = get_preprocessing_pool()
+    # Calls from inside the pool run serially, since waiting on the same pool could deadlock
+    if pool is None or len(items) <= 1 or getattr(_worker_state, "in_pool", False):
+        return [fn(item) for item in items]
+    return list(pool.map(fn, items))
+
+
+def prefetch(fn: Callable, items: Iterable, depth: Optional[int] = None) -> Iterator:
+    # Yields fn(item) in order, computing up to depth results ahead in a background thread,
+    # so the next batch is preprocessed while the current one is in the model
+    if depth is None:
+        depth = settings.PREPROCESSING_PREFETCH
+    if depth < 1:
+        yield from map(fn, items)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="surya-prefetch")
+    futures = deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) > depth:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
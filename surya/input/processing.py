@@ -1,6 +1,6 @@
 import os
 import random
-from typing import List
+from typing import List, Union
 
 import numpy as np
 import math
@@ -70,31 +70,41 @@ def slice_bboxes_from_image(image: Image.Image, bboxes):
 
 
 def slice_polys_from_image(image: Image.Image, polys):
+    # Converts the page to an array once, and reuses it for every line
+    image_array = np.asarray(image)
     lines = []
     for idx, poly in enumerate(polys):
-        lines.append(slice_and_pad_poly(image, poly, idx))
+        lines.append(slice_and_pad_poly(image_array, poly, idx))
     return lines
 
 
-def slice_and_pad_poly(image: Image.Image, coordinates, idx):
+def slice_and_pad_poly(image: Union[Image.Image, np.ndarray], coordinates, idx=None):
+    if isinstance(image, Image.Image):
+        image = np.asarray(image)
+    img_height, img_width = image.shape[:2]
+
+    # Mask only the rows the polygon covers.  Columns keep full image coordinates, since PIL rounds polygon edges
+    # differently at other x offsets, and the crop has to match masking the full image.
+    ys = [corner[1] for corner in coordinates]
+    top = max(int(math.floor(min(ys))), 0)
+    bottom = min(int(math.ceil(max(ys))) + 1, img_height)
+    right = min(int(math.ceil(max(corner[0] for corner in coordinates))) + 1, img_width)
+
     # Create a mask for the polygon
-    mask = Image.new('L', image.size, 0)
+    mask = Image.new('L', (max(right, 0), max(bottom - top, 0)), 0)
 
-    # coordinates must be in tuple form for PIL
-    coordinates = [(corner[0], corner[1]) for corner in coordinates]
+    # coordinates must be in tuple form for PIL, and relative to the first row
+    coordinates = [(corner[0], corner[1] - top) for corner in coordinates]
     ImageDraw.Draw(mask).polygon(coordinates, outline=1, fill=1)
     bbox = mask.getbbox()
-    mask = np.array(mask)
+    mask = np.array(mask.crop(bbox))
 
     # Extract the polygonal area from the image
-    polygon_image = np.array(image)
+    polygon_image = image[top + bbox[1]:top + bbox[3], bbox[0]:bbox[2]].copy()
     polygon_image[mask == 0] = 0
     polygon_image = Image.fromarray(polygon_image)
 
-    rectangle = Image.new('RGB', (bbox[2] - bbox[0], bbox[3] - bbox[1]), 'white')
-
-    # Paste the polygon into the rectangle
-    rectangle.paste(polygon_image.crop(bbox), (0, 0))
-
-    return rectangle
+    if polygon_image.mode != "RGB":
+        polygon_image = polygon_image.convert("RGB")
 
+    return polygon_image
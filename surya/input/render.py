@@ -0,0 +1,158 @@
+import hashlib
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional, Tuple
+
+import pypdfium2
+from PIL import Image
+
+# Only imports pdfium and PIL, so spawned render worker processes start quickly
+
+
+class PageRenderer:
+    # Keeps the last PDF open, since pages are rendered in order
+    def __init__(self):
+        self.doc_path = None
+        self.doc = None
+
+    def render(self, path: str, page_idx: Optional[int], dpi: int) -> Image.Image:
+        # page_idx is None for image files
+        if page_idx is None:
+            return Image.open(path).convert("RGB")
+
+        if self.doc_path != path:
+            self.close()
+            self.doc = pypdfium2.PdfDocument(path)
+            self.doc_path = path
+
+        page = self.doc[page_idx]
+        image = page.render(scale=dpi / 72).to_pil().convert("RGB")
+        page.close()
+        return image
+
+    def close(self):
+        if self.doc is not None:
+            self.doc.close()
+        self.doc = None
+        self.doc_path = None
+
+
+_worker_renderer = None
+
+
+def _init_worker():
+    global _worker_renderer
+    _worker_renderer = PageRenderer()
+
+
+def _render_in_worker(path: str, page_idx: Optional[int], dpi: int) -> Tuple[Image.Image, float]:
+    start = time.perf_counter()
+    image = _worker_renderer.render(path, page_idx, dpi)
+    return image, time.perf_counter() - start
+
+
+def render_pages(pages: Iterable[Tuple[str, Optional[int]]], dpi: int, workers: int = 1, prefetch_depth: int = 1) -> Iterator[Image.Image]:
+    # Renders (path, page index) pairs on demand and yields them in order, with up to prefetch_depth
+    # pages rendered ahead, so only those pages are in memory at once
+    # Imported here, since workers shouldn't need to import torch
+    from surya.instrumentation import record, span
+
+    if workers <= 1:
+        renderer = PageRenderer()
+        try:
+            for path, page_idx in pages:
+                with span("render"):
+                    image = renderer.render(path, page_idx, dpi)
+                yield image
+        finally:
+            renderer.close()
+        return
+
+    # Keep every worker busy
+    prefetch_depth = max(prefetch_depth, workers)
+    # Spawn, since the pool is often created from a thread after torch has started its own threads, and forking then can deadlock
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, mp_context=multiprocessing.get_context("spawn"))
+    futures = deque()
+    try:
+        for path, page_idx in pages:
+            futures.append(executor.submit(_render_in_worker, path, page_idx, dpi))
+            if len(futures) >= prefetch_depth:
+                image, duration = futures.popleft().result()
+                record("render", duration)
+                yield image
+        while len(futures) > 0:
+            image, duration = futures.popleft().result()
+            record("render", duration)
+            yield image
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class PdfPageCache:
+    # Renders single pages on request.  The last max_docs documents stay open, and the last max_pages rendered pages
+    # are kept, keyed by file hash, so a re-uploaded file still hits the cache.
+    def __init__(self, max_docs: int, max_pages: int):
+        self.max_docs = max_docs
+        self.max_pages = max_pages
+        self.docs = OrderedDict()
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()  # pdfium isn't thread safe
+
+    def get_doc(self, path: str) -> Tuple[str, pypdfium2.PdfDocument]:
+        key = file_hash(path)
+        if key in self.docs:
+            self.docs.move_to_end(key)
+            return key, self.docs[key]
+
+        # Load into memory, so the document stays valid if the file is removed
+        with open(path, "rb") as f:
+            doc = pypdfium2.PdfDocument(f.read())
+        self.docs[key] = doc
+        while len(self.docs) > self.max_docs:
+            _, evicted = self.docs.popitem(last=False)
+            evicted.close()
+        return key, doc
+
+    def page_count(self, path: str) -> int:
+        with self.lock:
+            _, doc = self.get_doc(path)
+            return len(doc)
+
+    def render(self, path: str, page_idx: int, dpi: int) -> Image.Image:
+        with self.lock:
+            key, doc = self.get_doc(path)
+            page_key = (key, page_idx, dpi)
+            if page_key in self.pages:
+                self.pages.move_to_end(page_key)
+                return self.pages[page_key]
+
+            if page_idx < 0 or page_idx >= len(doc):
+                raise ValueError(f"Page {page_idx + 1} is out of range, the PDF has {len(doc)} pages.")
+            page = doc[page_idx]
+            image = page.render(scale=dpi / 72).to_pil().convert("RGB")
+            page.close()
+
+            self.pages[page_key] = image
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+            return image
+
+    def close(self):
+        with self.lock:
+            for doc in self.docs.values():
+                doc.close()
+            self.docs.clear()
+            self.pages.clear()
@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from surya.settings import settings
+
+# Spans are only recorded when enabled.  Otherwise span() returns a shared no-op context manager, so instrumented
+# code only pays for one function call.
+_enabled = settings.INSTRUMENTATION
+_lock = threading.Lock()
+_durations = defaultdict(lambda: array("d"))
+_items = defaultdict(int)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("name", "items", "sync", "start")
+
+    def __init__(self, name: str, items: int, sync: bool):
+        self.name = name
+        self.items = items
+        self.sync = sync
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        # Kernels run asynchronously on GPU, so wait for them to get the real time
+        if self.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        record(self.name, time.perf_counter() - self.start, self.items)
+        return False
+
+
+def span(name: str, items: int = 1, sync: bool = False):
+    # Times the enclosed block.  items is how many pages, lines or batches it processed, for throughput.
+    if not _enabled:
+        return NULL_SPAN
+    return Span(name, items, sync)
+
+
+def record(name: str, duration: float, items: int = 1):
+    # For time measured elsewhere, like in a worker process
+    if not _enabled:
+        return
+    with _lock:
+        _durations[name].append(duration)
+        _items[name] += items
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _durations.clear()
+        _items.clear()
+
+
+def summary() -> dict:
+    # Spans that run on several threads at once can have a total above the wall clock time
+    with _lock:
+        stats = {}
+        for name, durations in _durations.items():
+            durations = np.array(durations, dtype=np.float64)
+            total = float(durations.sum())
+            stats[name] = {
+                "count": len(durations),
+                "items": _items[name],
+                "total": total,
+                "mean": total / len(durations),
+                "p50": float(np.percentile(durations, 50)),
+                "p90": float(np.percentile(durations, 90)),
+                "p99": float(np.percentile(durations, 99)),
+                "max": float(durations.max()),
+                "items_per_sec": _items[name] / total if total > 0 else None,
+            }
+        return stats
+
+
+def export_json(path: str):
+    with open(path, "w+") as f:
+        json.dump(summary(), f, indent=4)
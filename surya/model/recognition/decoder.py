@@ -45,56 +45,117 @@ class MBartExpertLayer(nn.Module):
         self.num_experts = len(self.lang_codes)
 
         self.experts = nn.ModuleDict({str(lang): MBartExpertMLP(config) for lang in self.lang_codes})
+        self._routing = None
 
-    def forward(self, hidden_states: torch.Tensor, langs: torch.LongTensor) -> torch.Tensor:
-        batch_size, sequence_length, hidden_dim = hidden_states.shape
+    def get_routing(self, langs: torch.LongTensor):
+        # langs is the same for every decoding step, so route once and reuse it until langs changes
+        if self._routing is not None and self._routing[0] is langs:
+            return self._routing[1]
 
-        final_hidden_states = torch.zeros(
-            (batch_size, sequence_length, hidden_dim), dtype=hidden_states.dtype, device=hidden_states.device
-        )
+        lang_codes = torch.tensor(self.lang_codes, dtype=langs.dtype, device=langs.device)
+        # (num_experts, batch_size) - which experts each sample uses
+        expert_mask = (langs[None, :, :] == lang_codes[:, None, None]).any(dim=-1)
+        expert_counts = expert_mask.sum(dim=-1).tolist()
+        # Sorted by expert, then by sample
+        expert_idx, sample_idx = torch.nonzero(expert_mask, as_tuple=True)
 
         # Weight experts based on how many languages in the input
         routing_weights = 1 / ((langs > 3).sum(axis=-1))
         # Set weights to 1 if zero experts activated
         routing_weights[torch.isinf(routing_weights)] = 1
+        sample_weights = routing_weights[sample_idx].reshape(-1, 1, 1)
 
-        # Loop over all available experts in the model and perform the computation on each expert
-        for expert_idx, expert_lang in enumerate(self.lang_codes):
-            # Check which samples match with this expert
-            lang_match = (langs == expert_lang).max(dim=-1).values
-            idx = torch.where(lang_match)[0]
-
-            if idx.shape[0] == 0:
+        # Only keep experts that are used by at least one sample
+        groups = []
+        group_start = 0
+        for expert_lang, count in zip(self.lang_codes, expert_counts):
+            if count == 0:
                 continue
+            groups.append((str(expert_lang), group_start, group_start + count))
+            group_start += count
+
+        routing = (groups, sample_idx, sample_weights)
+        self._routing = (langs, routing)
+        return routing
 
-            expert_layer = self.experts[str(expert_lang)]
+    def forward(self, hidden_states: torch.Tensor, langs: torch.LongTensor) -> torch.Tensor:
+        batch_size, sequence_length, hidden_dim = hidden_states.shape
+
+        final_hidden_states = torch.zeros(
+            (batch_size, sequence_length, hidden_dim), dtype=hidden_states.dtype, device=hidden_states.device
+        )
 
-            idx_list = idx.tolist()
-            current_state = hidden_states[idx_list].reshape(-1, hidden_dim)
+        groups, sample_idx, sample_weights = self.get_routing(langs)
+        if len(groups) == 0:
+            return final_hidden_states
+
+        # Gather the inputs for all experts at once, so each expert runs on a contiguous slice
+        expert_states = hidden_states.index_select(0, sample_idx)
+        expert_outputs = torch.empty_like(expert_states)
+        for expert_lang, group_start, group_end in groups:
+            expert_layer = self.experts[expert_lang]
+            current_state = expert_states[group_start:group_end].reshape(-1, hidden_dim)
             current_hidden_states = expert_layer(current_state)
             current_hidden_states = self.dropout(current_hidden_states)
-            current_hidden_states = current_hidden_states.reshape(-1, sequence_length, hidden_dim)
-
-            # Weight by number of languages in the input
-            selected_routing_weights = routing_weights[idx_list].reshape(-1, 1, 1)
-            current_hidden_states = current_hidden_states * selected_routing_weights
+            expert_outputs[group_start:group_end] = current_hidden_states.reshape(-1, sequence_length, hidden_dim)
 
-            final_hidden_states.index_add_(0, idx, current_hidden_states.to(hidden_states.dtype))
+        # Weight by number of languages in the input
+        expert_outputs = expert_outputs * sample_weights
+        final_hidden_states.index_add_(0, sample_idx, expert_outputs.to(hidden_states.dtype))
 
         return final_hidden_states
 
 
-def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
-    """
-    From llama
-    This is the equivalent of torch.repeat_interleave(x, dim=1, repeats=n_rep). The hidden states go from (batch,
-    num_key_value_heads, seqlen, head_dim) to (batch, num_attention_heads, seqlen, head_dim)
-    """
-    batch, num_key_value_heads, slen, head_dim = hidden_states.shape
-    if n_rep == 1:
-        return hidden_states
-    hidden_states = hidden_states[:, :, None, :, :].expand(batch, num_key_value_heads, n_rep, slen, head_dim)
-    return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
+class StaticKVCache:
+    # Preallocated self attention keys and values for one layer, written in place as decoding proceeds.
+    # The cache passed between steps is a view into these buffers, and the buffers are reused across batches.
+    def __init__(self, batch_size: int, max_length: int):
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.key_cache = None
+        self.value_cache = None
+
+    def _can_use(self, states: torch.Tensor, length: int) -> bool:
+        # Writing in place would break autograd
+        return not torch.is_grad_enabled() and states.shape[0] <= self.batch_size and length <= self.max_length
+
+    def _allocate(self, states: torch.Tensor):
+        bsz, num_kv_heads, _, head_dim = states.shape
+        shape = (self.batch_size, num_kv_heads, self.max_length, head_dim)
+        if (
+            self.key_cache is not None
+            and self.key_cache.shape == shape
+            and self.key_cache.dtype == states.dtype
+            and self.key_cache.device == states.device
+            and self.key_cache.is_inference() == torch.is_inference_mode_enabled()
+        ):
+            return
+        self.key_cache = torch.empty(shape, dtype=states.dtype, device=states.device)
+        self.value_cache = torch.empty(shape, dtype=states.dtype, device=states.device)
+
+    def owns(self, past_key_value: Tuple[torch.Tensor]) -> bool:
+        return self.key_cache is not None and past_key_value[0].data_ptr() == self.key_cache.data_ptr()
+
+    def start(self, key_states: torch.Tensor, value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # First step of a new batch, overwrites whatever the previous batch left
+        bsz, _, tgt_len, _ = key_states.shape
+        if not self._can_use(key_states, tgt_len):
+            return key_states, value_states
+
+        self._allocate(key_states)
+        self.key_cache[:bsz, :, :tgt_len] = key_states
+        self.value_cache[:bsz, :, :tgt_len] = value_states
+        return self.key_cache[:bsz, :, :tgt_len], self.value_cache[:bsz, :, :tgt_len]
+
+    def append(self, past_key_value: Tuple[torch.Tensor], key_states: torch.Tensor, value_states: torch.Tensor) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        bsz, _, past_len, _ = past_key_value[0].shape
+        new_len = past_len + key_states.shape[2]
+        if not self.owns(past_key_value) or not self._can_use(key_states, new_len):
+            return None
+
+        self.key_cache[:bsz, :, past_len:new_len] = key_states
+        self.value_cache[:bsz, :, past_len:new_len] = value_states
+        return self.key_cache[:bsz, :, :new_len], self.value_cache[:bsz, :, :new_len]
 
 
 class MBartGQAttention(nn.Module):
@@ -135,6 +196,7 @@ class MBartGQAttention(nn.Module):
         self.v_proj = nn.Linear(embed_dim, self.num_kv_heads * self.head_dim, bias=bias)
         self.q_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
         self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        self.static_cache: Optional[StaticKVCache] = None
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
@@ -142,26 +204,17 @@ class MBartGQAttention(nn.Module):
     def _shape_key_value(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_kv_heads, self.head_dim).transpose(1, 2).contiguous()
 
-    def forward(
+    def _project_key_value(
         self,
         hidden_states: torch.Tensor,
-        key_value_states: Optional[torch.Tensor] = None,
-        past_key_value: Optional[Tuple[torch.Tensor]] = None,
-        attention_mask: Optional[torch.Tensor] = None,
-        layer_head_mask: Optional[torch.Tensor] = None,
-        output_attentions: bool = False,
-    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-        """Input shape: Batch x Time x Channel"""
-
+        key_value_states: Optional[torch.Tensor],
+        past_key_value: Optional[Tuple[torch.Tensor]],
+        bsz: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[Tuple[torch.Tensor]]]:
         # if key_value_states are provided this layer is used as a cross-attention layer
         # for the decoder
         is_cross_attention = key_value_states is not None
 
-        bsz, tgt_len, _ = hidden_states.size()
-
-        # get query proj
-        query_states = self.q_proj(hidden_states) * self.scaling
-        # get key, value proj
         # `past_key_value[0].shape[2] == key_value_states.shape[1]`
         # is checking that the `sequence_length` of the `past_key_value` is the same as
         # the provided `key_value_states` to support prefix tuning
@@ -181,12 +234,18 @@ class MBartGQAttention(nn.Module):
             # reuse k, v, self_attention
             key_states = self._shape_key_value(self.k_proj(hidden_states), -1, bsz)
             value_states = self._shape_key_value(self.v_proj(hidden_states), -1, bsz)
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+            static_states = self.static_cache.append(past_key_value, key_states, value_states) if self.static_cache is not None else None
+            if static_states is not None:
+                key_states, value_states = static_states
+            else:
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
         else:
             # self_attention
             key_states = self._shape_key_value(self.k_proj(hidden_states), -1, bsz)
             value_states = self._shape_key_value(self.v_proj(hidden_states), -1, bsz)
+            if self.static_cache is not None:
+                key_states, value_states = self.static_cache.start(key_states, value_states)
 
         if self.is_decoder:
             # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
@@ -198,21 +257,40 @@ class MBartGQAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_states, value_states)
 
-        proj_shape = (bsz * self.num_heads, -1, self.head_dim)
-        query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
+        return key_states, value_states, past_key_value
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        """Input shape: Batch x Time x Channel"""
 
-        # Expand kv heads, then match query shape
-        key_states = repeat_kv(key_states, self.num_kv_groups)
-        value_states = repeat_kv(value_states, self.num_kv_groups)
+        bsz, tgt_len, _ = hidden_states.size()
+
+        # get query proj
+        query_states = self.q_proj(hidden_states) * self.scaling
+        # get key, value proj
+        key_states, value_states, past_key_value = self._project_key_value(hidden_states, key_value_states, past_key_value, bsz)
+
+        # Fold the query heads that share a kv head into the sequence dim, so the compact kv states can be used
+        # directly, instead of expanding them to one copy per query head on every step
+        proj_shape = (bsz * self.num_kv_heads, -1, self.head_dim)
+        query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
         key_states = key_states.reshape(*proj_shape)
         value_states = value_states.reshape(*proj_shape)
+        grouped_shape = (bsz, self.num_kv_heads, self.num_kv_groups, tgt_len, -1)
 
         src_len = key_states.size(1)
         attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
 
-        if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
+        if attn_weights.size() != (bsz * self.num_kv_heads, self.num_kv_groups * tgt_len, src_len):
             raise ValueError(
-                f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is"
+                f"Attention weights should be of size {(bsz * self.num_kv_heads, self.num_kv_groups * tgt_len, src_len)}, but is"
                 f" {attn_weights.size()}"
             )
 
@@ -221,8 +299,8 @@ class MBartGQAttention(nn.Module):
                 raise ValueError(
                     f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
                 )
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(*grouped_shape) + attention_mask.unsqueeze(2)
+            attn_weights = attn_weights.view(bsz * self.num_kv_heads, -1, src_len)
 
         attn_weights = nn.functional.softmax(attn_weights, dim=-1)
 
@@ -232,16 +310,13 @@ class MBartGQAttention(nn.Module):
                     f"Head mask for a single layer should be of size {(self.num_heads,)}, but is"
                     f" {layer_head_mask.size()}"
                 )
-            attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = layer_head_mask.view(1, self.num_kv_heads, self.num_kv_groups, 1, 1) * attn_weights.view(*grouped_shape)
+            attn_weights = attn_weights.view(bsz * self.num_kv_heads, -1, src_len)
 
         if output_attentions:
-            # this operation is a bit awkward, but it's required to
-            # make sure that attn_weights keeps its gradient.
-            # In order to do so, attn_weights have to be reshaped
-            # twice and have to be reused in the following
+            # Query heads sharing a kv head are adjacent, so this is the same as (bsz, num_heads, tgt_len, src_len)
             attn_weights_reshaped = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights_reshaped.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights_reshaped.view(bsz * self.num_kv_heads, -1, src_len)
         else:
             attn_weights_reshaped = None
 
@@ -249,9 +324,9 @@ class MBartGQAttention(nn.Module):
 
         attn_output = torch.bmm(attn_probs, value_states)
 
-        if attn_output.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
+        if attn_output.size() != (bsz * self.num_kv_heads, self.num_kv_groups * tgt_len, self.head_dim):
             raise ValueError(
-                f"`attn_output` should be of size {(bsz * self.num_heads, tgt_len, self.head_dim)}, but is"
+                f"`attn_output` should be of size {(bsz * self.num_kv_heads, self.num_kv_groups * tgt_len, self.head_dim)}, but is"
                 f" {attn_output.size()}"
             )
 
@@ -267,8 +342,66 @@ class MBartGQAttention(nn.Module):
         return attn_output, attn_weights_reshaped, past_key_value
 
 
+class MBartSdpaGQAttention(MBartGQAttention):
+    # Uses fused scaled dot product attention, which never materializes the attention weights
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if output_attentions or layer_head_mask is not None:
+            # sdpa can't return attention weights or apply a head mask
+            return super().forward(
+                hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        bsz, tgt_len, _ = hidden_states.size()
+
+        key_states, value_states, past_key_value = self._project_key_value(hidden_states, key_value_states, past_key_value, bsz)
+
+        # Fold the query heads that share a kv head into the sequence dim, so sdpa runs on the compact kv states
+        query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+        query_states = query_states.view(bsz, self.num_kv_heads, self.num_kv_groups * tgt_len, self.head_dim)
+
+        if attention_mask is not None:
+            src_len = key_states.size(2)
+            if attention_mask.size() != (bsz, 1, tgt_len, src_len):
+                raise ValueError(
+                    f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
+                )
+            attention_mask = attention_mask.unsqueeze(2).expand(-1, -1, self.num_kv_groups, -1, -1)
+            attention_mask = attention_mask.reshape(bsz, 1, self.num_kv_groups * tgt_len, -1)
+
+        attn_output = nn.functional.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            scale=self.scaling,
+        )
+
+        attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
+        attn_output = attn_output.transpose(1, 2)
+        attn_output = attn_output.reshape(bsz, tgt_len, self.embed_dim)
+
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, None, past_key_value
+
+
 MBART_ATTENTION_CLASSES = {
     "eager": MBartGQAttention,
+    "sdpa": MBartSdpaGQAttention,
     "flash_attention_2": None
 }
 
@@ -386,6 +519,8 @@ class MBartMoEDecoderLayer(nn.Module):
         return outputs
 
 class MBartMoEDecoder(MBartDecoder):
+    _supports_sdpa = True
+
     def __init__(self, config: MBartConfig, embed_tokens: Optional[nn.Embedding] = None):
         MBartPreTrainedModel.__init__(self, config)
         self.dropout = config.dropout
@@ -428,6 +563,7 @@ class MBartMoEDecoder(MBartDecoder):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPastAndCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -475,7 +611,11 @@ class MBartMoEDecoder(MBartDecoder):
                 )
 
         # embed positions
-        positions = self.embed_positions(input, past_key_values_length)
+        if position_ids is None:
+            positions = self.embed_positions(input, past_key_values_length)
+        else:
+            # Per-row positions, when rows in the batch are at different decoding steps
+            positions = nn.Embedding.forward(self.embed_positions, position_ids + self.embed_positions.offset)
 
         hidden_states = inputs_embeds + positions.to(inputs_embeds.device)
         hidden_states = self.layernorm_embedding(hidden_states)
@@ -578,6 +718,7 @@ class MBartMoEDecoderWrapper(MBartPreTrainedModel):
     This wrapper class is a helper class to correctly load pretrained checkpoints when the causal language model is
     used in combination with the [`EncoderDecoderModel`] framework.
     """
+    _supports_sdpa = True
 
     def __init__(self, config):
         super().__init__(config)
@@ -590,6 +731,7 @@ class MBartMoEDecoderWrapper(MBartPreTrainedModel):
 class MBartMoE(MBartForCausalLM):
     config_class = MBartMoEConfig
     _tied_weights_keys = ["lm_head.weight"]
+    _supports_sdpa = True
 
     def __init__(self, config):
         config = copy.deepcopy(config)
@@ -619,6 +761,7 @@ class MBartMoE(MBartForCausalLM):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -641,6 +784,7 @@ class MBartMoE(MBartForCausalLM):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            position_ids=position_ids,
         )
 
         logits = self.lm_head(outputs[0])
@@ -691,6 +835,17 @@ class MBartMoE(MBartForCausalLM):
             "langs": langs
         }
 
+    def set_static_cache(self, batch_size: int, max_length: int):
+        # Preallocate the self attention kv cache, instead of growing it every step
+        for layer in self.model.decoder.layers:
+            cache = layer.self_attn.static_cache
+            if cache is None or cache.batch_size < batch_size or cache.max_length < max_length:
+                layer.self_attn.static_cache = StaticKVCache(batch_size, max_length)
+
+    def clear_static_cache(self):
+        for layer in self.model.decoder.layers:
+            layer.self_attn.static_cache = None
+
     def prune_moe_experts(self, keep_keys: List[int]):
         # Remove experts not specified in keep_keys
         str_keep_keys = [str(key) for key in keep_keys]
@@ -702,4 +857,9 @@ class MBartMoE(MBartForCausalLM):
             for lang in lang_keys:
                 if lang not in str_keep_keys:
                     layer.moe.experts.pop(lang)
-            layer.lang_codes = keep_keys
\ No newline at end of file
+            layer.moe.lang_codes = sorted(int(key) for key in lang_keys if key in str_keep_keys)
+            layer.moe.num_experts = len(layer.moe.lang_codes)
+            layer.moe._routing = None
+
+        # Keep the config in sync, so a pruned model can be saved and loaded directly
+        self.config.langs = {lang: code for lang, code in self.config.langs.items() if str(code) in str_keep_keys}
\ No newline at end of file
@@ -3,6 +3,7 @@ from transformers import VisionEncoderDecoderModel, VisionEncoderDecoderConfig,
 from surya.model.recognition.config import MBartMoEConfig, VariableDonutSwinConfig
 from surya.model.recognition.encoder import VariableDonutSwinModel
 from surya.model.recognition.decoder import MBartMoE
+from surya.model.recognition.processor import SuryaImageProcessor
 from surya.settings import settings
 
 
@@ -11,8 +12,15 @@ def load_model(checkpoint=settings.RECOGNITION_MODEL_CHECKPOINT, device=settings
 
     decoder_config = vars(config.decoder)
     decoder = MBartMoEConfig(**decoder_config)
+    decoder._attn_implementation = settings.RECOGNITION_ATTENTION_IMPLEMENTATION
     config.decoder = decoder
 
+    # Checkpoints saved with save_pruned_model only have experts for some languages
+    if langs is not None:
+        missing_langs = set(langs) - set(decoder.langs.values())
+        if len(missing_langs) > 0:
+            raise ValueError(f"Recognition checkpoint {checkpoint} has no experts for language tokens {sorted(missing_langs)}.")
+
     encoder_config = vars(config.encoder)
     encoder = VariableDonutSwinConfig(**encoder_config)
     config.encoder = encoder
@@ -36,6 +44,17 @@ def load_model(checkpoint=settings.RECOGNITION_MODEL_CHECKPOINT, device=settings
     return model
 
 
+def save_pruned_model(model, save_dir: str, langs: List[int], checkpoint=settings.RECOGNITION_MODEL_CHECKPOINT):
+    # Save a checkpoint with only the experts for langs, which loads faster and uses less memory
+    model.decoder.prune_moe_experts(langs)
+    model.save_pretrained(save_dir)
+
+    # Copy the image processor config, so the folder can be used as RECOGNITION_MODEL_CHECKPOINT.  The tokenizer has no config.
+    image_processor = SuryaImageProcessor.from_pretrained(checkpoint)
+    image_processor.save_pretrained(save_dir)
+    print(f"Saved recognition model with {len(model.decoder.config.langs)} languages to {save_dir}")
+
+
 class LangVisionEncoderDecoderModel(VisionEncoderDecoderModel):
     def prepare_inputs_for_generation(
             self, input_ids, decoder_langs=None, past_key_values=None, attention_mask=None, use_cache=None, encoder_outputs=None, **kwargs
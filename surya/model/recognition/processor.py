@@ -3,18 +3,19 @@ from typing import Dict, Union, Optional, List, Tuple
 from torch import TensorType
 from transformers import DonutImageProcessor, DonutProcessor, AutoImageProcessor, DonutSwinConfig
 from transformers.image_processing_utils import BaseImageProcessor, get_size_dict, BatchFeature
-from transformers.image_transforms import to_channel_dimension_format, pad, _rescale_for_pil_conversion, to_pil_image
+from transformers.image_transforms import to_channel_dimension_format, _rescale_for_pil_conversion, to_pil_image
 from transformers.image_utils import PILImageResampling, ImageInput, ChannelDimension, make_list_of_images, \
     valid_images, to_numpy_array, is_scaled_image, infer_channel_dimension_format, get_image_size
 import numpy as np
 from PIL import Image
 import PIL
+from surya.input.prefetch import parallel_map
 from surya.model.recognition.tokenizer import Byt5LangTokenizer
 from surya.settings import settings
 
 
-def load_processor():
-    processor = SuryaProcessor()
+def load_processor(checkpoint=settings.RECOGNITION_MODEL_CHECKPOINT):
+    processor = SuryaProcessor(checkpoint=checkpoint)
     processor.image_processor.train = False
     processor.image_processor.max_size = settings.RECOGNITION_IMAGE_SIZE
     processor.tokenizer.model_max_length = settings.RECOGNITION_MAX_TOKENS
@@ -29,14 +30,6 @@ class SuryaImageProcessor(DonutImageProcessor):
         self.max_size = max_size
         self.train = train
 
-    def numpy_resize(self, image: np.ndarray, size, resample):
-        image = PIL.Image.fromarray(image)
-        resized = self.pil_resize(image, size, resample)
-        resized = np.array(resized, dtype=np.uint8)
-        resized_image = resized.transpose(2, 0, 1)
-
-        return resized_image
-
     def pil_resize(self, image: PIL.Image.Image, size, resample):
         width, height = image.size
         max_width, max_height = size["width"], size["height"]
@@ -56,58 +49,58 @@ class SuryaImageProcessor(DonutImageProcessor):
 
         return image
 
-    def process_inner(self, images: List[List], train=False):
-        # This will be in list of lists format, with height x width x channel
-        assert isinstance(images[0], (list, np.ndarray))
+    def process_inner(self, images: List[Union[List, np.ndarray, Image.Image]], train=False) -> np.ndarray:
+        # Images are PIL images, or in list of lists/array format with height x width x channel
+        max_height, max_width = self.max_size["height"], self.max_size["width"]
 
-        # convert list of lists format to array
-        if isinstance(images[0], list):
-            # numpy unit8 needed for augmentation
-            np_images = [np.array(img, dtype=np.uint8) for img in images]
+        # Resized images are written straight into one buffer, already padded with 255 (whitespace)
+        # Pad to max size to improve performance
+        padded = np.full((len(images), max_height, max_width, 3), 255, dtype=np.uint8)
+        resized = parallel_map(lambda image: self.align_and_resize(image, self.max_size, self.resample), images)
+        for i, image in enumerate(resized):
+            height, width = image.shape[:2]
+            delta_height = max_height - height
+            delta_width = max_width - width
+
+            if train:
+                # Change amount of padding randomly during training
+                pad_top = np.random.randint(low=0, high=delta_height + 1)
+                pad_left = np.random.randint(low=0, high=delta_width + 1)
+            else:
+                pad_top = delta_height // 2
+                pad_left = delta_width // 2
+            padded[i, pad_top:pad_top + height, pad_left:pad_left + width] = image
+
+        # Rescale and normalize in one pass over the batch, which also moves to channel x height x width
+        mean = np.array(self.image_mean, dtype=np.float32).reshape(1, -1, 1, 1)
+        std = np.array(self.image_std, dtype=np.float32).reshape(1, -1, 1, 1)
+        pixel_values = np.empty((len(images), 3, max_height, max_width), dtype=np.float32)
+        np.multiply(padded.transpose(0, 3, 1, 2), np.float32(self.rescale_factor), out=pixel_values)
+        pixel_values -= mean
+        pixel_values /= std
+
+        return pixel_values
+
+    def align_and_resize(self, image: Union[List, np.ndarray, Image.Image], size, resample) -> np.ndarray:
+        if isinstance(image, Image.Image):
+            image = image if image.mode == "RGB" else image.convert("RGB")
+            # Rotate if the bbox is wider than it is tall
+            if (size["width"] < size["height"] and image.width > image.height) or (
+                size["width"] > size["height"] and image.width < image.height
+            ):
+                image = image.transpose(Image.Transpose.ROTATE_270)
         else:
-            np_images = [img.astype(np.uint8) for img in images]
-
-        assert np_images[0].shape[2] == 3 # RGB input images, channel dim last
-
-        # Rotate if the bbox is wider than it is tall
-        np_images = [self.align_long_axis(image, size=self.max_size, input_data_format=ChannelDimension.LAST) for image in np_images]
+            # numpy unit8 needed for augmentation
+            image = np.asarray(image, dtype=np.uint8)
+            assert image.shape[2] == 3 # RGB input images, channel dim last
+            image = self.align_long_axis(image, size=size, input_data_format=ChannelDimension.LAST)
+            image = Image.fromarray(np.ascontiguousarray(image))
 
         # Verify that the image is wider than it is tall
-        for img in np_images:
-            assert img.shape[1] >= img.shape[0]
-
-        # This also applies the right channel dim format, to channel x height x width
-        np_images = [self.numpy_resize(img, self.max_size, self.resample) for img in np_images]
-        assert np_images[0].shape[0] == 3 # RGB input images, channel dim first
-
-        # Convert to float32 for rescale/normalize
-        np_images = [img.astype(np.float32) for img in np_images]
-
-        # Pads with 255 (whitespace)
-        # Pad to max size to improve performance
-        max_size = self.max_size
-        np_images = [
-            self.pad_image(
-                image=image,
-                size=max_size,
-                random_padding=train, # Change amount of padding randomly during training
-                input_data_format=ChannelDimension.FIRST,
-                pad_value=255.0
-            )
-            for image in np_images
-        ]
-        # Rescale and normalize
-        np_images = [
-            self.rescale(img, scale=self.rescale_factor, input_data_format=ChannelDimension.FIRST)
-            for img in np_images
-        ]
-        np_images = [
-            self.normalize(img, mean=self.image_mean, std=self.image_std, input_data_format=ChannelDimension.FIRST)
-            for img in np_images
-        ]
-
-        return np_images
+        assert image.width >= image.height
 
+        resized = self.pil_resize(image, size, resample)
+        return np.asarray(resized, dtype=np.uint8)
 
     def preprocess(
         self,
@@ -137,43 +130,13 @@ class SuryaImageProcessor(DonutImageProcessor):
                 "torch.Tensor, tf.Tensor or jax.ndarray."
             )
 
-        # Convert to numpy for later processing steps
-        images = [to_numpy_array(image) for image in images]
+        # PIL images are resized directly, anything else is converted to numpy
+        images = [image if isinstance(image, Image.Image) else to_numpy_array(image) for image in images]
 
         images = self.process_inner(images, train=self.train)
         data = {"pixel_values": images}
         return BatchFeature(data=data, tensor_type=return_tensors)
 
-    def pad_image(
-        self,
-        image: np.ndarray,
-        size: Dict[str, int],
-        random_padding: bool = False,
-        data_format: Optional[Union[str, ChannelDimension]] = None,
-        input_data_format: Optional[Union[str, ChannelDimension]] = None,
-        pad_value: float = 0.0,
-    ) -> np.ndarray:
-        output_height, output_width = size["height"], size["width"]
-        input_height, input_width = get_image_size(image, channel_dim=input_data_format)
-
-        delta_width = output_width - input_width
-        delta_height = output_height - input_height
-
-        assert delta_width >= 0 and delta_height >= 0
-
-        if random_padding:
-            pad_top = np.random.randint(low=0, high=delta_height + 1)
-            pad_left = np.random.randint(low=0, high=delta_width + 1)
-        else:
-            pad_top = delta_height // 2
-            pad_left = delta_width // 2
-
-        pad_bottom = delta_height - pad_top
-        pad_right = delta_width - pad_left
-
-        padding = ((pad_top, pad_bottom), (pad_left, pad_right))
-        return pad(image, padding, data_format=data_format, input_data_format=input_data_format, constant_values=pad_value)
-
     def align_long_axis(
         self,
         image: np.ndarray,
@@ -193,8 +156,8 @@ class SuryaImageProcessor(DonutImageProcessor):
 
 
 class SuryaProcessor(DonutProcessor):
-    def __init__(self, image_processor=None, tokenizer=None, train=False, **kwargs):
-        image_processor = SuryaImageProcessor.from_pretrained(settings.RECOGNITION_MODEL_CHECKPOINT)
+    def __init__(self, image_processor=None, tokenizer=None, train=False, checkpoint=settings.RECOGNITION_MODEL_CHECKPOINT, **kwargs):
+        image_processor = SuryaImageProcessor.from_pretrained(checkpoint)
         tokenizer = Byt5LangTokenizer()
         if image_processor is None:
             raise ValueError("You need to specify an `image_processor`.")
@@ -1,15 +1,21 @@
+import itertools
+import queue
+import threading
 from collections import defaultdict
-from typing import List
+from typing import List, Iterable, Iterator, Optional
 from tqdm import tqdm
 
 import torch
 from PIL import Image
 
-from surya.detection import batch_detection
+from surya.cache import get_result_cache, ocr_key
+from surya.detection import batch_detection, get_batch_size as get_det_batch_size
 from surya.input.processing import slice_polys_from_image, slice_bboxes_from_image
+from surya.instrumentation import span
 from surya.postprocessing.text import truncate_repetitions, sort_text_lines
 from surya.recognition import batch_recognition
-from surya.schema import TextLine, OCRResult
+from surya.schema import TextLine, OCRResult, DetectionResult
+from surya.settings import settings
 
 
 def run_recognition(images: List[Image.Image], langs: List[List[str]], rec_model, rec_processor, bboxes: List[List[List[int]]] = None, polygons: List[List[List[List[int]]]] = None) -> List[OCRResult]:
@@ -59,7 +65,58 @@ def run_recognition(images: List[Image.Image], langs: List[List[str]], rec_model
     return predictions_by_image
 
 
+def slice_page_lines(image: Image.Image, det_pred: DetectionResult) -> List[Image.Image]:
+    polygons = [p.polygon for p in det_pred.bboxes]
+    with span("slicing", items=len(polygons)):
+        return slice_polys_from_image(image, polygons)
+
+
+def build_ocr_result(det_pred: DetectionResult, image_lines: List[str], lang: List[str]) -> OCRResult:
+    assert len(image_lines) == len(det_pred.bboxes)
+
+    # Remove repeated characters
+    image_lines = [truncate_repetitions(l) for l in image_lines]
+    lines = []
+    for text_line, bbox in zip(image_lines, det_pred.bboxes):
+        lines.append(TextLine(
+            text=text_line,
+            polygon=bbox.polygon,
+            bbox=bbox.bbox
+        ))
+
+    lines = sort_text_lines(lines)
+
+    return OCRResult(
+        text_lines=lines,
+        languages=lang,
+        image_bbox=det_pred.image_bbox
+    )
+
+
+def cached_ocr_iter(images: Iterable[Image.Image], langs: Iterable[List[str]], det_model, rec_model, run_fn) -> Iterator[OCRResult]:
+    # run_fn(images, langs) runs OCR on the pages that aren't cached, and yields results in order
+    cache = get_result_cache()
+    if cache is None or not settings.RESULT_CACHE_OCR:
+        return iter(run_fn(images, langs))
+
+    def run_uncached(pages):
+        image_pages, lang_pages = itertools.tee(pages)
+        return iter(run_fn((image for image, _ in image_pages), (lang for _, lang in lang_pages)))
+
+    return cache.cached_iter(
+        "ocr",
+        zip(images, langs),
+        lambda page: ocr_key(page[0], page[1], det_model, rec_model),
+        run_uncached
+    )
+
+
 def run_ocr(images: List[Image.Image], langs: List[List[str]], det_model, det_processor, rec_model, rec_processor) -> List[OCRResult]:
+    run_fn = lambda images, langs: run_ocr_uncached(list(images), list(langs), det_model, det_processor, rec_model, rec_processor)
+    return list(cached_ocr_iter(images, langs, det_model, rec_model, run_fn))
+
+
+def run_ocr_uncached(images: List[Image.Image], langs: List[List[str]], det_model, det_processor, rec_model, rec_processor) -> List[OCRResult]:
     det_predictions = batch_detection(images, det_model, det_processor)
     if det_model.device == "cuda":
         torch.cuda.empty_cache() # Empty cache from first model run
@@ -68,8 +125,7 @@ def run_ocr(images: List[Image.Image], langs: List[List[str]], det_model, det_pr
     all_slices = []
     all_langs = []
     for idx, (image, det_pred, lang) in enumerate(zip(images, det_predictions, langs)):
-        polygons = [p.polygon for p in det_pred.bboxes]
-        slices = slice_polys_from_image(image, polygons)
+        slices = slice_page_lines(image, det_pred)
         slice_map.append(len(slices))
         all_slices.extend(slices)
         all_langs.extend([lang] * len(slices))
@@ -78,29 +134,133 @@ def run_ocr(images: List[Image.Image], langs: List[List[str]], det_model, det_pr
 
     predictions_by_image = []
     slice_start = 0
-    for idx, (image, det_pred, lang) in enumerate(zip(images, det_predictions, langs)):
+    for idx, (det_pred, lang) in enumerate(zip(det_predictions, langs)):
         slice_end = slice_start + slice_map[idx]
         image_lines = rec_predictions[slice_start:slice_end]
         slice_start = slice_end
 
-        assert len(image_lines) == len(det_pred.bboxes)
+        predictions_by_image.append(build_ocr_result(det_pred, image_lines, lang))
 
-        # Remove repeated characters
-        image_lines = [truncate_repetitions(l) for l in image_lines]
-        lines = []
-        for text_line, bbox in zip(image_lines, det_pred.bboxes):
-            lines.append(TextLine(
-                text=text_line,
-                polygon=bbox.polygon,
-                bbox=bbox.bbox
-            ))
+    return predictions_by_image
 
-        lines = sort_text_lines(lines)
 
-        predictions_by_image.append(OCRResult(
-            text_lines=lines,
-            languages=lang,
-            image_bbox=det_pred.image_bbox
-        ))
+class PipelineError:
+    def __init__(self, error: Exception):
+        self.error = error
 
-    return predictions_by_image
+
+PIPELINE_DONE = object()
+
+
+class PipelineStage(threading.Thread):
+    # Runs one stage of the OCR pipeline, reading from one bounded queue and writing to the next
+    def __init__(self, fn, in_queue: Optional[queue.Queue], out_queue: queue.Queue, stop_event: threading.Event):
+        super().__init__(daemon=True)
+        self.fn = fn
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stop_event = stop_event
+        self.end_item = PIPELINE_DONE
+
+    def put(self, item):
+        # Block while the next stage is busy, but give up if the consumer went away
+        while not self.stop_event.is_set():
+            try:
+                self.out_queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def inputs(self):
+        while not self.stop_event.is_set():
+            try:
+                item = self.in_queue.get(timeout=.1)
+            except queue.Empty:
+                continue
+
+            if item is PIPELINE_DONE:
+                return
+            if isinstance(item, PipelineError):
+                # Pass upstream errors through to the consumer
+                self.end_item = item
+                return
+            yield item
+
+    def run(self):
+        try:
+            items = self.fn() if self.in_queue is None else map(self.fn, self.inputs())
+            for item in items:
+                if not self.put(item):
+                    return
+        except Exception as e:
+            self.end_item = PipelineError(e)
+        self.put(self.end_item)
+
+
+def run_ocr_pipelined(images: Iterable[Image.Image], langs: Iterable[List[str]], det_model, det_processor, rec_model, rec_processor, pages_per_batch: Optional[int] = None, queue_size: Optional[int] = None) -> Iterator[OCRResult]:
+    run_fn = lambda images, langs: run_ocr_pipelined_uncached(images, langs, det_model, det_processor, rec_model, rec_processor, pages_per_batch, queue_size)
+    return cached_ocr_iter(images, langs, det_model, rec_model, run_fn)
+
+
+def run_ocr_pipelined_uncached(images: Iterable[Image.Image], langs: Iterable[List[str]], det_model, det_processor, rec_model, rec_processor, pages_per_batch: Optional[int] = None, queue_size: Optional[int] = None) -> Iterator[OCRResult]:
+    # Detection, line slicing, and recognition run in their own threads, connected by bounded queues.
+    # Detection of batch N+1 overlaps slicing and recognition of batch N, and results are yielded in page order.
+    if pages_per_batch is None:
+        pages_per_batch = settings.OCR_PIPELINE_PAGES_PER_BATCH or get_det_batch_size()
+    if queue_size is None:
+        queue_size = settings.OCR_PIPELINE_QUEUE_SIZE
+
+    def detect():
+        pages = zip(images, langs)
+        while True:
+            batch = list(itertools.islice(pages, pages_per_batch))
+            if len(batch) == 0:
+                return
+            batch_images = [image for image, _ in batch]
+            batch_langs = [lang for _, lang in batch]
+            det_predictions = batch_detection(batch_images, det_model, det_processor)
+            yield batch_images, batch_langs, det_predictions
+
+    def slice_lines(item):
+        batch_images, batch_langs, det_predictions = item
+        batch_slices = [slice_page_lines(image, det_pred) for image, det_pred in zip(batch_images, det_predictions)]
+        return batch_langs, det_predictions, batch_slices
+
+    stop_event = threading.Event()
+    det_queue = queue.Queue(maxsize=queue_size)
+    slice_queue = queue.Queue(maxsize=queue_size)
+    stages = [
+        PipelineStage(detect, None, det_queue, stop_event),
+        PipelineStage(slice_lines, det_queue, slice_queue, stop_event),
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        while True:
+            item = slice_queue.get()
+            if item is PIPELINE_DONE:
+                break
+            if isinstance(item, PipelineError):
+                raise item.error
+
+            batch_langs, det_predictions, batch_slices = item
+            all_slices = []
+            all_langs = []
+            for slices, lang in zip(batch_slices, batch_langs):
+                all_slices.extend(slices)
+                all_langs.extend([lang] * len(slices))
+
+            rec_predictions = batch_recognition(all_slices, all_langs, rec_model, rec_processor)
+
+            slice_start = 0
+            for det_pred, slices, lang in zip(det_predictions, batch_slices, batch_langs):
+                slice_end = slice_start + len(slices)
+                yield build_ocr_result(det_pred, rec_predictions[slice_start:slice_end], lang)
+                slice_start = slice_end
+    finally:
+        # Also stops the worker threads if the caller stops consuming results early
+        stop_event.set()
+        for stage in stages:
+            stage.join()
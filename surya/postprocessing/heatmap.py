@@ -1,4 +1,5 @@
-from typing import List
+from collections import defaultdict
+from typing import List, Optional, Tuple
 
 import numpy as np
 import cv2
@@ -10,35 +11,64 @@ from surya.schema import PolygonBox
 from surya.settings import settings
 
 
-def clean_contained_boxes(boxes: List[PolygonBox]) -> List[PolygonBox]:
+def clean_contained_boxes(boxes: List[PolygonBox], max_cells_per_box=16) -> List[PolygonBox]:
+    # Removes boxes that are contained in another (different) box
+    # Boxes are bucketed into a grid with cells about the size of a typical box.  Any box that contains another
+    # box also contains its top left corner, so only boxes in the grid cell of that corner need to be compared.
+    if len(boxes) < 2:
+        return list(boxes)
+
+    coords = np.array([box_obj.bbox for box_obj in boxes], dtype=np.float64)
+    x1, y1, x2, y2 = coords.T
+    cell_width = max(np.median(x2 - x1), 1)
+    cell_height = max(np.median(y2 - y1), 1)
+    start_cols = np.floor((x1 - x1.min()) / cell_width).astype(int)
+    end_cols = np.floor((x2 - x1.min()) / cell_width).astype(int)
+    start_rows = np.floor((y1 - y1.min()) / cell_height).astype(int)
+    end_rows = np.floor((y2 - y1.min()) / cell_height).astype(int)
+
+    # Very large boxes would fill up too many cells, so they are compared against every box instead
+    cell_counts = (end_cols - start_cols + 1) * (end_rows - start_rows + 1)
+    large_idxs = np.where(cell_counts > max_cells_per_box)[0]
+    grid = defaultdict(list)
+    for j in np.where(cell_counts <= max_cells_per_box)[0]:
+        for col in range(start_cols[j], end_cols[j] + 1):
+            for row in range(start_rows[j], end_rows[j] + 1):
+                grid[(col, row)].append(j)
+
+    def is_contained(i, candidates):
+        others = coords[candidates]
+        box = coords[i]
+        # Boxes with the exact same bbox don't count as containing each other
+        different = np.any(others != box, axis=1)
+        contains = (box[0] >= others[:, 0]) & (box[1] >= others[:, 1]) & (box[2] <= others[:, 2]) & (box[3] <= others[:, 3])
+        return bool(np.any(different & contains))
+
     new_boxes = []
-    for box_obj in boxes:
-        box = box_obj.bbox
+    for i, box_obj in enumerate(boxes):
         contained = False
-        for other_box_obj in boxes:
-            if other_box_obj.polygon == box_obj.polygon:
-                continue
-
-            other_box = other_box_obj.bbox
-            if box == other_box:
-                continue
-            if box[0] >= other_box[0] and box[1] >= other_box[1] and box[2] <= other_box[2] and box[3] <= other_box[3]:
-                contained = True
-                break
+        if len(large_idxs) > 0:
+            contained = is_contained(i, large_idxs)
+        if not contained:
+            contained = is_contained(i, grid[(start_cols[i], start_rows[i])])
         if not contained:
             new_boxes.append(box_obj)
     return new_boxes
 
 
-def get_dynamic_thresholds(linemap, text_threshold, low_text, typical_top10_avg=.7):
-    # Find average intensity of top 10% pixels
-    # Do top 10% to account for pdfs that are mostly whitespace, etc.
-    flat_map = linemap.flatten()
-    sorted_map = np.sort(flat_map)[::-1]
-    top_10_count = int(np.ceil(len(flat_map) * 0.1))
-    top_10 = sorted_map[:top_10_count]
-    avg_intensity = np.mean(top_10)
+def get_top_10_avg(flat_maps: np.ndarray) -> np.ndarray:
+    # Average of the top 10% of values in each row of a (batch, pixels) array.  Partitions flat_maps in place.
+    # Selects the top 10% with a partition instead of sorting the whole map.  Only the selected values are sorted,
+    # in descending order, so the mean is summed in the same order as a full sort would give.
+    pixel_count = flat_maps.shape[-1]
+    top_10_count = int(np.ceil(pixel_count * 0.1))
+    flat_maps.partition(pixel_count - top_10_count, axis=-1)
+    top_10 = flat_maps[..., pixel_count - top_10_count:]
+    top_10 = np.sort(top_10, axis=-1)[..., ::-1]
+    return np.array([np.mean(row) for row in top_10.reshape(-1, top_10_count)])
 
+
+def scale_thresholds(avg_intensity, text_threshold, low_text, typical_top10_avg=.7):
     # Adjust thresholds based on normalized intensityy
     scaling_factor = min(1, avg_intensity / typical_top10_avg) ** (1 / 2)
 
@@ -50,13 +80,39 @@ def get_dynamic_thresholds(linemap, text_threshold, low_text, typical_top10_avg=
     return text_threshold, low_text
 
 
-def detect_boxes(linemap, text_threshold, low_text):
+def get_dynamic_thresholds(linemap, text_threshold, low_text, typical_top10_avg=.7):
+    # Find average intensity of top 10% pixels
+    # Do top 10% to account for pdfs that are mostly whitespace, etc.
+    flat_map = linemap.flatten()
+    avg_intensity = get_top_10_avg(flat_map.reshape(1, -1))[0]
+    return scale_thresholds(avg_intensity, text_threshold, low_text, typical_top10_avg)
+
+
+def get_dynamic_thresholds_batch(linemaps: List[np.ndarray], text_threshold, low_text, typical_top10_avg=.7) -> List[Tuple[float, float]]:
+    # Same as get_dynamic_thresholds, but selects the top 10% for all maps of the same shape in one call
+    avg_intensities = [None] * len(linemaps)
+    shape_groups = defaultdict(list)
+    for i, linemap in enumerate(linemaps):
+        shape_groups[linemap.shape].append(i)
+
+    for shape, idxs in shape_groups.items():
+        flat_maps = np.stack([linemaps[i].reshape(-1) for i in idxs], axis=0)
+        for i, avg_intensity in zip(idxs, get_top_10_avg(flat_maps)):
+            avg_intensities[i] = avg_intensity
+
+    return [scale_thresholds(avg_intensity, text_threshold, low_text, typical_top10_avg) for avg_intensity in avg_intensities]
+
+
+def detect_boxes(linemap, text_threshold, low_text, thresholds: Optional[Tuple[float, float]] = None):
     # From CRAFT - https://github.com/clovaai/CRAFT-pytorch
     # prepare data
     linemap = linemap.copy()
     img_h, img_w = linemap.shape
 
-    text_threshold, low_text = get_dynamic_thresholds(linemap, text_threshold, low_text)
+    # Thresholds can be precomputed for a whole batch with get_dynamic_thresholds_batch
+    if thresholds is None:
+        thresholds = get_dynamic_thresholds(linemap, text_threshold, low_text)
+    text_threshold, low_text = thresholds
 
     ret, text_score = cv2.threshold(linemap, low_text, 1, cv2.THRESH_BINARY)
 
@@ -70,15 +126,15 @@ def detect_boxes(linemap, text_threshold, low_text):
         if size < 10:
             continue
 
+        # Only work inside the component bounding box, not the full page
+        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+        component_mask = labels[y:y + h, x:x + w] == k
+
         # thresholding
-        if np.max(linemap[labels == k]) < text_threshold:
+        if np.max(linemap[y:y + h, x:x + w][component_mask]) < text_threshold:
             continue
 
-        # make segmentation map
-        segmap = np.zeros(linemap.shape, dtype=np.uint8)
-        segmap[labels == k] = 255
-        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
-        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
         niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
         sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
 
@@ -92,11 +148,16 @@ def detect_boxes(linemap, text_threshold, low_text):
         if ey >= img_h:
             ey = img_h
 
+        # make segmentation map, covering the component plus the dilation margin
+        segmap = np.zeros((ey - sy, ex - sx), dtype=np.uint8)
+        segmap[y - sy:y - sy + h, x - sx:x - sx + w][component_mask] = 255
+
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(1 + niter, 1 + niter))
-        segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
+        segmap = cv2.dilate(segmap, kernel)
 
-        # make box
+        # make box, shifting points back to page coordinates
         np_contours = np.roll(np.array(np.where(segmap != 0)),1, axis=0).transpose().reshape(-1,2)
+        np_contours += np.array([sx, sy], dtype=np_contours.dtype)
         rectangle = cv2.minAreaRect(np_contours)
         box = cv2.boxPoints(rectangle)
 
@@ -118,10 +179,10 @@ def detect_boxes(linemap, text_threshold, low_text):
     return det, labels
 
 
-def get_detected_boxes(textmap, text_threshold=settings.DETECTOR_TEXT_THRESHOLD,  low_text=settings.DETECTOR_BLANK_THRESHOLD) -> List[PolygonBox]:
+def get_detected_boxes(textmap, text_threshold=settings.DETECTOR_TEXT_THRESHOLD,  low_text=settings.DETECTOR_BLANK_THRESHOLD, thresholds: Optional[Tuple[float, float]] = None) -> List[PolygonBox]:
     textmap = textmap.copy()
     textmap = textmap.astype(np.float32)
-    boxes, labels = detect_boxes(textmap, text_threshold, low_text)
+    boxes, labels = detect_boxes(textmap, text_threshold, low_text, thresholds)
     # From point form to box form
     boxes = [box.tolist() for box in boxes]
     # print("aaaaaaaaaaaaa",boxes)
@@ -129,8 +190,8 @@ def get_detected_boxes(textmap, text_threshold=settings.DETECTOR_TEXT_THRESHOLD,
     return boxes
 
 
-def get_and_clean_boxes(textmap, processor_size, image_size) -> List[PolygonBox]:
-    bboxes = get_detected_boxes(textmap)
+def get_and_clean_boxes(textmap, processor_size, image_size, thresholds: Optional[Tuple[float, float]] = None) -> List[PolygonBox]:
+    bboxes = get_detected_boxes(textmap, thresholds=thresholds)
     for bbox in bboxes:
         bbox.rescale(processor_size, image_size)
     bboxes = clean_contained_boxes(bboxes)
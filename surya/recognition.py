@@ -1,6 +1,10 @@
-from typing import List
+from collections import deque
+from typing import List, Optional, Tuple
 import torch
 from PIL import Image
+from surya.cache import get_line_cache, line_key
+from surya.input.prefetch import prefetch
+from surya.instrumentation import span
 from surya.settings import settings
 from tqdm import tqdm
 import numpy as np
@@ -17,28 +21,221 @@ def get_batch_size():
     return batch_size
 
 
-def batch_recognition(images: List, languages: List[List[str]], model, processor):
-    assert all([isinstance(image, Image.Image) for image in images])
-    assert len(images) == len(languages)
+def get_length_order(images: List[Image.Image]) -> List[int]:
+    # Lines are rotated so the long axis is horizontal, then resized to a fixed height.  So the aspect ratio
+    # approximates how much text is in the line, and how many steps it will take to decode.
+    aspect_ratios = [max(image.size) / max(min(image.size), 1) for image in images]
+    return sorted(range(len(images)), key=lambda i: aspect_ratios[i], reverse=True)
+
+
+def get_decode_steps(generated_ids: torch.Tensor, prefix_length: int, eos_id: int) -> Tuple[int, int]:
+    # Returns total decode steps run for the batch, and steps actually needed by each sequence (up to and including eos)
+    new_tokens = generated_ids[:, prefix_length:]
+    batch_size, steps = new_tokens.shape
+    is_eos = new_tokens == eos_id
+    lengths = torch.where(is_eos.any(dim=-1), is_eos.int().argmax(dim=-1) + 1, steps)
+    return batch_size * steps, int(lengths.sum())
+
+
+def pad_left(tensor: torch.Tensor, length: int, dim: int, value=0) -> torch.Tensor:
+    pad_length = length - tensor.shape[dim]
+    if pad_length == 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = pad_length
+    padding = torch.full(pad_shape, value, dtype=tensor.dtype, device=tensor.device)
+    return torch.cat([padding, tensor], dim=dim)
+
+
+class DecodeBatch:
+    # The sequences currently being decoded, with their kv cache.  Self attention caches are left padded, so every
+    # row can be at a different step, with attention_mask marking the valid cache positions in each row.
+    def __init__(self, line_idxs: List[int], past_key_values, attention_mask, position_ids, langs, encoder_hidden_states, next_tokens):
+        self.line_idxs = line_idxs
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.position_ids = position_ids
+        self.langs = langs
+        self.encoder_hidden_states = encoder_hidden_states
+        self.next_tokens = next_tokens
+
+    def __len__(self):
+        return len(self.line_idxs)
+
+    def keep(self, keep_rows: List[int]):
+        # Evict finished rows from the batch and the cache
+        keep_idx = torch.tensor(keep_rows, dtype=torch.long, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, keep_idx)
+
+        # Drop cache columns that were only used by evicted rows
+        start = int(attention_mask.any(dim=0).int().argmax()) if len(keep_rows) > 0 else attention_mask.shape[1]
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(
+            (self_key.index_select(0, keep_idx)[:, :, start:], self_value.index_select(0, keep_idx)[:, :, start:], cross_key.index_select(0, keep_idx), cross_value.index_select(0, keep_idx))
+            for self_key, self_value, cross_key, cross_value in self.past_key_values
+        )
+        self.line_idxs = [self.line_idxs[i] for i in keep_rows]
+        self.position_ids = self.position_ids.index_select(0, keep_idx)
+        self.langs = self.langs.index_select(0, keep_idx)
+        self.encoder_hidden_states = self.encoder_hidden_states.index_select(0, keep_idx)
+        self.next_tokens = self.next_tokens.index_select(0, keep_idx)
+
+    def extend(self, other: "DecodeBatch"):
+        # Add new rows into the free slots, left padding the caches to the same length
+        cache_length = max(self.attention_mask.shape[1], other.attention_mask.shape[1])
+        lang_length = max(self.langs.shape[1], other.langs.shape[1])
+        self.attention_mask = torch.cat([pad_left(self.attention_mask, cache_length, 1), pad_left(other.attention_mask, cache_length, 1)], dim=0)
+        self.past_key_values = tuple(
+            tuple(
+                torch.cat([pad_left(cache, cache_length, 2), pad_left(other_cache, cache_length, 2)], dim=0) if i < 2 else torch.cat([cache, other_cache], dim=0)
+                for i, (cache, other_cache) in enumerate(zip(layer_cache, other_layer_cache))
+            )
+            for layer_cache, other_layer_cache in zip(self.past_key_values, other.past_key_values)
+        )
+        self.line_idxs = self.line_idxs + other.line_idxs
+        self.position_ids = torch.cat([self.position_ids, other.position_ids], dim=0)
+        # Language padding is 0, which doesn't activate any expert
+        self.langs = torch.cat([pad_left(self.langs, lang_length, 1), pad_left(other.langs, lang_length, 1)], dim=0)
+        self.encoder_hidden_states = torch.cat([self.encoder_hidden_states, other.encoder_hidden_states], dim=0)
+        self.next_tokens = torch.cat([self.next_tokens, other.next_tokens], dim=0)
+
+
+def start_decode_batch(line_idxs: List[int], images: List[Image.Image], line_langs: List[List[int]], model, processor) -> DecodeBatch:
+    # Run the encoder on new lines, and run the decoder over their prompts to fill the cache
+    with span("recognition_preprocess", items=len(images)):
+        model_inputs = processor(images=images)
+    with span("generate", items=len(images), sync=True):
+        pixel_values = torch.from_numpy(model_inputs["pixel_values"]).to(model.device, dtype=model.dtype)
+        encoder_hidden_states = model.encoder(pixel_values=pixel_values)[0]
+        if model.encoder.config.hidden_size != model.decoder.config.hidden_size and model.decoder.config.cross_attention_hidden_size is None:
+            encoder_hidden_states = model.enc_to_dec_proj(encoder_hidden_states)
+
+        # Prompts have a different length when lines have different numbers of languages, so left pad them
+        prompts = [[model.config.decoder_start_token_id] + lang for lang in line_langs]
+        prompt_length = max(len(prompt) for prompt in prompts)
+        lang_length = max(len(lang) for lang in line_langs)
+        input_ids = torch.tensor([[processor.tokenizer.pad_id] * (prompt_length - len(prompt)) + prompt for prompt in prompts], dtype=torch.long, device=model.device)
+        attention_mask = torch.tensor([[0] * (prompt_length - len(prompt)) + [1] * len(prompt) for prompt in prompts], dtype=torch.long, device=model.device)
+        langs = torch.tensor([[0] * (lang_length - len(lang)) + lang for lang in line_langs], dtype=torch.long, device=model.device)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        outputs = model.decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            langs=langs,
+            encoder_hidden_states=encoder_hidden_states,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True
+        )
+        next_tokens = outputs.logits[:, -1].argmax(dim=-1)
+    return DecodeBatch(line_idxs, outputs.past_key_values, attention_mask, position_ids[:, -1] + 1, langs, encoder_hidden_states, next_tokens)
+
+
+def continuous_batch_recognition(images: List[Image.Image], languages: List[List[str]], model, processor) -> Tuple[List[str], int]:
+    # Greedy decoding, where finished lines leave the batch right away and pending lines take their slots.
+    # This keeps the decoder batch full, instead of waiting for the longest line in each batch.
+    if len(images) == 0:
+        return [], 0
+
     batch_size = get_batch_size()
+    # Refill once enough slots are free, so the encoder doesn't run on tiny batches
+    refill_size = max(batch_size // 4, 1)
+    eos_id = processor.tokenizer.eos_id
+    # Lines start decoding at different times, so they can't share one static cache
+    model.decoder.clear_static_cache()
+    forced_eos_id = model.generation_config.forced_eos_token_id
+    line_langs = processor.tokenizer([""] * len(languages), languages)["langs"]
 
-    images = [image.convert("RGB") for image in images]
+    pending = deque(range(len(images)))
+    generated = [[] for _ in range(len(images))]
+    output_text = [None] * len(images)
+    decode_steps = 0
+    batch = None
+    progress = tqdm(total=len(images), desc="Recognizing Text")
+    with torch.inference_mode():
+        while len(pending) > 0 or (batch is not None and len(batch) > 0):
+            active = 0 if batch is None else len(batch)
+            free_slots = batch_size - active
+            if len(pending) > 0 and (free_slots >= min(refill_size, len(pending)) or active == 0):
+                line_idxs = [pending.popleft() for _ in range(min(free_slots, len(pending)))]
+                new_batch = start_decode_batch(line_idxs, [images[i] for i in line_idxs], [line_langs[i] for i in line_idxs], model, processor)
+                if batch is None or active == 0:
+                    batch = new_batch
+                else:
+                    batch.extend(new_batch)
 
-    output_text = []
-    for i in tqdm(range(0, len(images), batch_size), desc="Recognizing Text"):
+            keep_rows = []
+            for row, (line_idx, token) in enumerate(zip(batch.line_idxs, batch.next_tokens.tolist())):
+                at_max_tokens = len(generated[line_idx]) + 1 >= settings.RECOGNITION_MAX_TOKENS
+                if at_max_tokens and forced_eos_id is not None:
+                    # Match generate, which forces the last token
+                    token = forced_eos_id
+                generated[line_idx].append(token)
+                if token == eos_id or at_max_tokens:
+                    with span("decode"):
+                        output_text[line_idx] = processor.tokenizer.decode(generated[line_idx])
+                    progress.update(1)
+                else:
+                    keep_rows.append(row)
+
+            if len(keep_rows) < len(batch):
+                batch.keep(keep_rows)
+            if len(batch) == 0:
+                continue
+
+            # Lines are counted when they start decoding
+            with span("generate", items=0, sync=True):
+                attention_mask = torch.cat([batch.attention_mask, batch.attention_mask.new_ones((len(batch), 1))], dim=1)
+                outputs = model.decoder(
+                    input_ids=batch.next_tokens.unsqueeze(1),
+                    attention_mask=attention_mask,
+                    langs=batch.langs,
+                    encoder_hidden_states=batch.encoder_hidden_states,
+                    past_key_values=batch.past_key_values,
+                    position_ids=batch.position_ids.unsqueeze(1),
+                    use_cache=True,
+                    return_dict=True
+                )
+                batch.past_key_values = outputs.past_key_values
+                batch.attention_mask = attention_mask
+                batch.position_ids = batch.position_ids + 1
+                batch.next_tokens = outputs.logits[:, -1].argmax(dim=-1)
+            decode_steps += len(batch)
+    progress.close()
+
+    return output_text, decode_steps
+
+
+def padded_batch_recognition(images: List[Image.Image], languages: List[List[str]], model, processor) -> Tuple[List[str], int, int]:
+    batch_size = get_batch_size()
+    if settings.RECOGNITION_STATIC_CACHE:
+        # The decoder prompt is the start token plus one token per language
+        max_prompt_length = 1 + max([len(lang) for lang in languages], default=0)
+        model.decoder.set_static_cache(batch_size, max_prompt_length + settings.RECOGNITION_MAX_TOKENS)
+
+    def preprocess(i):
         batch_langs = languages[i:i+batch_size]
         batch_images = images[i:i+batch_size]
-        model_inputs = processor(text=[""] * len(batch_langs), images=batch_images, lang=batch_langs)
+        with span("recognition_preprocess", items=len(batch_images)):
+            return processor(text=[""] * len(batch_langs), images=batch_images, lang=batch_langs)
 
+    output_text = []
+    total_steps = 0
+    useful_steps = 0
+    batch_starts = range(0, len(images), batch_size)
+    progress = tqdm(total=len(batch_starts), desc="Recognizing Text")
+    # Preprocess the next batch while the current one is decoding
+    for model_inputs in prefetch(preprocess, batch_starts):
         batch_pixel_values = model_inputs["pixel_values"]
         batch_langs = model_inputs["langs"]
         batch_decoder_input = [[model.config.decoder_start_token_id] + lang for lang in batch_langs]
 
         batch_langs = torch.from_numpy(np.array(batch_langs, dtype=np.int64)).to(model.device)
-        batch_pixel_values = torch.tensor(np.array(batch_pixel_values), dtype=model.dtype).to(model.device)
+        batch_pixel_values = torch.from_numpy(batch_pixel_values).to(model.device, dtype=model.dtype)
         batch_decoder_input = torch.from_numpy(np.array(batch_decoder_input, dtype=np.int64)).to(model.device)
 
-        with torch.inference_mode():
+        with torch.inference_mode(), span("generate", items=len(batch_langs), sync=True):
             generated_ids = model.generate(
                 pixel_values=batch_pixel_values,
                 decoder_input_ids=batch_decoder_input,
@@ -47,12 +244,74 @@ def batch_recognition(images: List, languages: List[List[str]], model, processor
                 max_new_tokens=settings.RECOGNITION_MAX_TOKENS
             )
 
-        output_text.extend(processor.tokenizer.batch_decode(generated_ids))
+        with span("decode", items=len(generated_ids)):
+            output_text.extend(processor.tokenizer.batch_decode(generated_ids))
+
+        batch_steps, batch_useful_steps = get_decode_steps(generated_ids, batch_decoder_input.shape[1], processor.tokenizer.eos_id)
+        total_steps += batch_steps
+        useful_steps += batch_useful_steps
+        progress.set_postfix(wasted_steps=f"{1 - useful_steps / max(total_steps, 1):.2f}")
+        progress.update(1)
+    progress.close()
+
+    return output_text, total_steps, useful_steps
 
-    return output_text
 
+def batch_recognition(images: List, languages: List[List[str]], model, processor, sort_by_length: Optional[bool] = None, return_stats: bool = False, continuous_batching: Optional[bool] = None):
+    assert all([isinstance(image, Image.Image) for image in images])
+    assert len(images) == len(languages)
+    if sort_by_length is None:
+        sort_by_length = settings.RECOGNITION_SORT_BY_LENGTH
+    if continuous_batching is None:
+        continuous_batching = settings.RECOGNITION_CONTINUOUS_BATCHING
+
+    images = [image.convert("RGB") for image in images]
 
+    # Lines that are cached, or repeated within this call (headers, footers, table labels), aren't decoded again
+    line_cache = get_line_cache()
+    ordered_text = [None] * len(images)
+    pending = {}  # Lines that need decoding, by key
+    for idx, (image, lang) in enumerate(zip(images, languages)):
+        key = idx
+        if line_cache is not None:
+            key = line_key(image, lang, model)
+            ordered_text[idx] = line_cache.get(key)
+        if ordered_text[idx] is None:
+            pending.setdefault(key, []).append(idx)
+    keys = list(pending.keys())
+    images = [images[pending[key][0]] for key in keys]
+    languages = [languages[pending[key][0]] for key in keys]
 
+    # Batch lines of similar length together, so short lines don't wait on long ones to finish decoding
+    order = list(range(len(images)))
+    if sort_by_length:
+        order = get_length_order(images)
+    images = [images[i] for i in order]
+    languages = [languages[i] for i in order]
 
+    if continuous_batching:
+        # Finished sequences leave the batch, so every decode step is useful
+        output_text, total_steps = continuous_batch_recognition(images, languages, model, processor)
+        useful_steps = total_steps
+    else:
+        output_text, total_steps, useful_steps = padded_batch_recognition(images, languages, model, processor)
 
+    # Put text back in input order
+    for i, text in zip(order, output_text):
+        key = keys[i]
+        if line_cache is not None:
+            line_cache.put(key, text)
+        for idx in pending[key]:
+            ordered_text[idx] = text
+    if line_cache is not None:
+        line_cache.flush()
 
+    if return_stats:
+        stats = {
+            "decode_steps": total_steps,
+            "useful_decode_steps": useful_steps,
+            "wasted_step_ratio": 1 - useful_steps / max(total_steps, 1),
+            "decoded_lines": len(keys),
+        }
+        return ordered_text, stats
+    return ordered_text
@@ -0,0 +1,254 @@
+import asyncio
+import base64
+import io
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from PIL import Image
+
+from surya.detection import get_batch_size as get_det_batch_size
+from surya.input.langs import replace_lang_with_code
+from surya.ocr import run_ocr
+from surya.recognition import batch_recognition, get_batch_size as get_rec_batch_size
+from surya.settings import settings
+
+MAX_BODY_SIZE = 64 * 1024 * 1024
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class DynamicBatcher:
+    # Collects items from concurrent requests, and runs them through run_fn together.  A batch runs once it has
+    # max_batch_size items, or max_wait seconds after its first request came in.  Requests that arrive while the model
+    # is busy are queued for the next batch.
+    def __init__(self, run_fn: Callable[[List], List], max_batch_size: int, max_wait: float, executor: ThreadPoolExecutor):
+        self.run_fn = run_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, items: List) -> List:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, future))
+        return await future
+
+    async def next_batch(self) -> List[Tuple[List, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        requests = [await self.queue.get()]
+        batch_size = len(requests[0][0])
+        deadline = loop.time() + self.max_wait
+        while batch_size < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            requests.append(request)
+            batch_size += len(request[0])
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.next_batch()
+            items = [item for request_items, _ in requests for item in request_items]
+            try:
+                # The model runs off the event loop, so requests keep queueing up while it works
+                results = await loop.run_in_executor(self.executor, self.run_fn, items)
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(items)
+            start = 0
+            for request_items, future in requests:
+                end = start + len(request_items)
+                # Skip requests whose client went away
+                if not future.done():
+                    future.set_result(results[start:end])
+                start = end
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "queued": self.queue.qsize(),
+            "mean_batch_size": self.items / max(self.batches, 1),
+        }
+
+
+def run_by_lang_count(items: List[Tuple[Image.Image, List[str]]], run_fn: Callable[[List], List]) -> List:
+    # Recognition batches need the same number of languages for every line, so requests with different numbers of
+    # languages run as separate batches.  Results come back in input order.
+    groups = defaultdict(list)
+    for idx, (_, langs) in enumerate(items):
+        groups[len(langs)].append(idx)
+
+    results = [None] * len(items)
+    for idxs in groups.values():
+        for idx, result in zip(idxs, run_fn([items[idx] for idx in idxs])):
+            results[idx] = result
+    return results
+
+
+def decode_image(data: str) -> Image.Image:
+    try:
+        return Image.open(io.BytesIO(base64.b64decode(data))).convert("RGB")
+    except Exception:
+        raise RequestError(400, "Images must be base64 encoded image files.")
+
+
+def parse_langs(payload: dict) -> List[str]:
+    langs = payload.get("langs")
+    if not isinstance(langs, list) or len(langs) == 0 or not all(isinstance(lang, str) for lang in langs):
+        raise RequestError(400, "langs must be a list of language codes.")
+    try:
+        replace_lang_with_code(langs)
+    except ValueError as e:
+        raise RequestError(400, str(e))
+    return langs
+
+
+class OCRServer:
+    # HTTP API over run_ocr and batch_recognition, with pages and line images from concurrent requests batched together.
+    # POST /ocr {"image": base64 image, "langs": [...]} returns an OCRResult.
+    # POST /recognize {"images": [base64 line images], "langs": [...]} returns {"text": [...]}.
+    # GET /health returns batching stats.
+    def __init__(self, det_model, det_processor, rec_model, rec_processor, max_batch_pages: Optional[int] = None, max_batch_lines: Optional[int] = None, max_wait: Optional[float] = None):
+        self.det_model = det_model
+        self.det_processor = det_processor
+        self.rec_model = rec_model
+        self.rec_processor = rec_processor
+        self.max_batch_pages = max_batch_pages or settings.SERVER_MAX_BATCH_PAGES or get_det_batch_size()
+        self.max_batch_lines = max_batch_lines or settings.SERVER_MAX_BATCH_LINES or get_rec_batch_size()
+        self.max_wait = max_wait if max_wait is not None else settings.SERVER_MAX_WAIT_MS / 1000
+        self.page_batcher = None
+        self.line_batcher = None
+
+    def run_pages(self, pages: List[Tuple[Image.Image, List[str]]]) -> List[dict]:
+        return run_by_lang_count(pages, self._run_pages)
+
+    def _run_pages(self, pages: List[Tuple[Image.Image, List[str]]]) -> List[dict]:
+        predictions = run_ocr([image for image, _ in pages], [langs for _, langs in pages], self.det_model, self.det_processor, self.rec_model, self.rec_processor)
+        return [pred.model_dump() for pred in predictions]
+
+    def run_lines(self, lines: List[Tuple[Image.Image, List[str]]]) -> List[str]:
+        return run_by_lang_count(lines, self._run_lines)
+
+    def _run_lines(self, lines: List[Tuple[Image.Image, List[str]]]) -> List[str]:
+        return batch_recognition([image for image, _ in lines], [langs for _, langs in lines], self.rec_model, self.rec_processor)
+
+    async def route(self, method: str, path: str, body: bytes) -> dict:
+        path = path.split("?")[0]
+        if path == "/health":
+            if method != "GET":
+                raise RequestError(405, "Use GET.")
+            return {"status": "ok", "pages": self.page_batcher.stats(), "lines": self.line_batcher.stats()}
+        if path not in ["/ocr", "/recognize"]:
+            raise RequestError(404, f"No route for {path}.")
+        if method != "POST":
+            raise RequestError(405, "Use POST.")
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise RequestError(400, "Body must be JSON.")
+        if not isinstance(payload, dict):
+            raise RequestError(400, "Body must be a JSON object.")
+        langs = parse_langs(payload)
+
+        loop = asyncio.get_running_loop()
+        if path == "/ocr":
+            image = await loop.run_in_executor(None, decode_image, payload.get("image", ""))
+            result = await self.page_batcher.submit([(image, langs)])
+            return result[0]
+
+        images = payload.get("images")
+        if not isinstance(images, list):
+            raise RequestError(400, "images must be a list of base64 encoded images.")
+        images = await loop.run_in_executor(None, lambda: [decode_image(image) for image in images])
+        text = await self.line_batcher.submit([(image, langs) for image in images])
+        return {"text": text}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Connections are kept alive until the client closes them
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length > MAX_BODY_SIZE:
+                        raise RequestError(413, f"Body is larger than {MAX_BODY_SIZE} bytes.")
+                    body = await reader.readexactly(content_length)
+                    status, response = 200, await self.route(method, path, body)
+                except RequestError as e:
+                    status, response = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, response = 500, {"error": repr(e)}
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" and status != 413
+                data = json.dumps(response, ensure_ascii=False).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Client went away, or sent something that isn't HTTP
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        # One thread runs the models, so batches never run concurrently
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="surya-server")
+        self.page_batcher = DynamicBatcher(self.run_pages, self.max_batch_pages, self.max_wait, executor)
+        self.line_batcher = DynamicBatcher(self.run_lines, self.max_batch_lines, self.max_wait, executor)
+        batch_tasks = [asyncio.create_task(self.page_batcher.run()), asyncio.create_task(self.line_batcher.run())]
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving OCR on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in batch_tasks:
+                task.cancel()
+            executor.shutdown(wait=False)
@@ -9,6 +9,15 @@ class Settings(BaseSettings):
     # General
     TORCH_DEVICE: Optional[str] = None
     IMAGE_DPI: int = 96
+    PREPROCESSING_WORKERS: Optional[int] = None  # Threads for resizing images, defaults to the number of CPUs
+    PREPROCESSING_PREFETCH: int = 1  # Batches preprocessed ahead while the model runs, 0 to disable
+    INSTRUMENTATION: bool = False  # Record timings for each pipeline stage, see surya/instrumentation.py
+
+    # PDF rendering
+    PDF_RENDER_WORKERS: Optional[int] = None  # Processes for rendering pages lazily, defaults to the number of CPUs (max 8)
+    PDF_RENDER_PREFETCH: int = 8  # Pages rendered ahead of processing
+    PDF_DOC_CACHE_SIZE: int = 4  # Open documents kept for single page requests (predict.py)
+    PDF_PAGE_CACHE_SIZE: int = 32  # Rendered pages kept for single page requests (predict.py)
 
     # Paths
     DATA_DIR: str = "data"
@@ -28,11 +37,38 @@ class Settings(BaseSettings):
     RECOGNITION_MODEL_CHECKPOINT: str = "vikp/surya_rec"
     RECOGNITION_MAX_TOKENS: int = 160
     RECOGNITION_BATCH_SIZE: Optional[int] = None  # Defaults to 8 for CPU/MPS, 256 otherwise
+    RECOGNITION_SORT_BY_LENGTH: bool = False  # Batch lines of similar length together, instead of in input order
+    RECOGNITION_CONTINUOUS_BATCHING: bool = False  # Replace finished lines in the decoder batch with pending lines
+    RECOGNITION_STATIC_CACHE: bool = True  # Preallocate the decoder kv cache and write to it in place
+    RECOGNITION_ATTENTION_IMPLEMENTATION: str = "eager"  # eager or sdpa, check sdpa with benchmark/attention.py first
+    RECOGNITION_LINE_CACHE_SIZE: int = 0  # Recognized lines kept in memory, so repeated lines (headers, footers) skip the model.  Off by default, try 10000
+    RECOGNITION_LINE_CACHE_DIR: Optional[str] = None  # Lines evicted from memory spill to disk here, and are kept across runs
+    RECOGNITION_LINE_CACHE_DISK_SIZE: int = 1000000  # Max lines kept on disk
     RECOGNITION_IMAGE_SIZE: Dict = {"height": 196, "width": 896}
     RECOGNITION_RENDER_FONT: str = os.path.join(FONT_DIR, "GoNotoKurrent-Regular.ttf")
     RECOGNITION_FONT_DL_PATH: str = "https://github.com/satbyy/go-noto-universal/releases/download/v7.0/GoNotoKurrent-Regular.ttf"
     RECOGNITION_BENCH_DATASET_NAME: str = "vikp/rec_bench"
 
+    # OCR pipeline
+    OCR_PIPELINE_PAGES_PER_BATCH: Optional[int] = None  # Pages detected per pipeline step, defaults to the detector batch size
+    OCR_PIPELINE_QUEUE_SIZE: int = 2  # Batches buffered between pipeline stages
+    OCR_WORKERS: int = 1  # Processes to run OCR in.  Helps on CPU hosts with many cores
+    OCR_WORKER_THREADS: Optional[int] = None  # Torch threads per worker process, defaults to the number of CPUs divided by the workers
+    OCR_WORKER_SHARED_WEIGHTS: bool = True  # Load models once, and map the weights into every worker (CPU only)
+
+    # OCR server
+    SERVER_HOST: str = "127.0.0.1"
+    SERVER_PORT: int = 8000
+    SERVER_MAX_BATCH_PAGES: Optional[int] = None  # Pages from concurrent requests run together, defaults to the detector batch size
+    SERVER_MAX_BATCH_LINES: Optional[int] = None  # Line images from concurrent requests run together, defaults to the recognition batch size
+    SERVER_MAX_WAIT_MS: int = 20  # How long a batch waits for more requests before it runs
+
+    # Result cache
+    RESULT_CACHE_DIR: Optional[str] = None  # Cache detection and OCR results on disk, keyed by page pixels, languages and model
+    RESULT_CACHE_MAX_SIZE: int = 1024  # In MB, least recently used results are evicted past this
+    RESULT_CACHE_DETECTION: bool = True  # Cache detection results
+    RESULT_CACHE_OCR: bool = True  # Cache OCR results
+
     # Tesseract (for benchmarks only)
     TESSDATA_PREFIX: Optional[str] = None
 
@@ -0,0 +1,129 @@
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing
+from PIL import Image
+
+from surya.detection import get_batch_size as get_det_batch_size
+from surya.schema import OCRResult
+from surya.settings import settings
+
+_worker_models = None
+
+
+def get_worker_threads(workers: int) -> int:
+    threads = settings.OCR_WORKER_THREADS
+    if threads is None:
+        threads = (os.cpu_count() or 1) // workers
+    return max(threads, 1)
+
+
+def load_worker_models(rec_langs: Optional[List[int]] = None):
+    # Imported here, so the parent process doesn't need to load model code to start the pool
+    from surya.model.detection.segformer import load_model as load_detection_model, load_processor as load_detection_processor
+    from surya.model.recognition.model import load_model as load_recognition_model
+    from surya.model.recognition.processor import load_processor as load_recognition_processor
+
+    return load_detection_model(), load_detection_processor(), load_recognition_model(langs=rec_langs), load_recognition_processor()
+
+
+def share_models(models: Tuple) -> Tuple:
+    # Moves weights into shared memory, so workers map the same pages instead of loading their own copy.
+    # Only works for models on CPU, models on other devices are returned as is.
+    # The default file_descriptor strategy keeps an fd open per tensor, and the full recognition model has more tensors
+    # than the usual 1024 fd limit.  file_system shares them by name instead.
+    torch.multiprocessing.set_sharing_strategy("file_system")
+    for model in models:
+        if isinstance(model, torch.nn.Module) and all(param.device.type == "cpu" for param in model.parameters()):
+            model.share_memory()
+    return models
+
+
+def _init_worker(parent_settings: dict, threads: int, model_loader: Callable, rec_langs: Optional[List[int]], models: Optional[Tuple]):
+    global _worker_models
+    # Spawned workers only see settings from the environment, so copy over any that were changed in the parent
+    for key, value in parent_settings.items():
+        setattr(settings, key, value)
+
+    # Small batches don't scale past a few threads, so each worker gets its own share of the cores
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    if settings.PREPROCESSING_WORKERS is None:
+        settings.PREPROCESSING_WORKERS = threads
+    # Shared models arrive as handles to the parent's weights, so only activations use worker memory
+    _worker_models = models if models is not None else model_loader(rec_langs)
+
+
+def _run_in_worker(images: List[Image.Image], langs: List[List[str]]) -> List[OCRResult]:
+    from surya.ocr import run_ocr
+
+    det_model, det_processor, rec_model, rec_processor = _worker_models
+    return run_ocr(images, langs, det_model, det_processor, rec_model, rec_processor)
+
+
+class OCRWorkerPool:
+    # Runs OCR in separate processes, each with its own torch threads.  Used on CPU hosts with many cores,
+    # where one process running torch with all of the threads leaves most of them idle.  Workers map the weights of
+    # models if they are passed in (see share_models), and load their own copy with model_loader otherwise.
+    def __init__(self, workers: Optional[int] = None, threads_per_worker: Optional[int] = None, rec_langs: Optional[List[int]] = None, model_loader: Callable = load_worker_models, models: Optional[Tuple] = None):
+        if workers is None:
+            workers = settings.OCR_WORKERS
+        if threads_per_worker is None:
+            threads_per_worker = get_worker_threads(workers)
+
+        self.workers = workers
+        # Forking a process that has started torch threads can deadlock.  The torch context sends shared
+        # tensors to spawned workers as handles, instead of copying them.
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=torch.multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(settings.dict(), threads_per_worker, model_loader, rec_langs, models)
+        )
+
+    def run(self, images: Iterable[Image.Image], langs: Iterable[List[str]], pages_per_task: Optional[int] = None) -> Iterator[OCRResult]:
+        # Sends pages to workers in chunks, and yields results in page order.  Only a couple of chunks per worker are
+        # in flight, so lazily loaded pages aren't all rendered at once.
+        if pages_per_task is None:
+            pages_per_task = settings.OCR_PIPELINE_PAGES_PER_BATCH or get_det_batch_size()
+
+        pages = zip(images, langs)
+        chunks = iter(lambda: list(itertools.islice(pages, pages_per_task)), [])
+        futures = deque()
+        try:
+            for chunk in chunks:
+                futures.append(self.executor.submit(_run_in_worker, [image for image, _ in chunk], [lang for _, lang in chunk]))
+                if len(futures) >= self.workers * 2:
+                    yield from futures.popleft().result()
+            while len(futures) > 0:
+                yield from futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_ocr_parallel(images: Iterable[Image.Image], langs: Iterable[List[str]], workers: Optional[int] = None, threads_per_worker: Optional[int] = None, rec_langs: Optional[List[int]] = None, model_loader: Callable = load_worker_models, shared_weights: Optional[bool] = None) -> Iterator[OCRResult]:
+    # Like run_ocr, but pages are split across worker processes
+    if shared_weights is None:
+        shared_weights = settings.OCR_WORKER_SHARED_WEIGHTS
+
+    models = None
+    if shared_weights and settings.TORCH_DEVICE_MODEL == "cpu" and settings.TORCH_DEVICE_DETECTION == "cpu":
+        # Load once here, and let workers map the weights
+        models = share_models(model_loader(rec_langs))
+
+    with OCRWorkerPool(workers, threads_per_worker, rec_langs, model_loader, models) as pool:
+        yield from pool.run(images, langs)